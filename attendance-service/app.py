@@ -7,61 +7,406 @@ import json
 import base64
 import io
 import re
+import time
+import random
+import cProfile
+import pstats
+import contextvars
+import uuid
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Tuple
-from flask import Flask, request, jsonify
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Iterable, Callable, BinaryIO, Union
+from flask import Flask, request, jsonify, g, Response, stream_with_context
 from flask_cors import CORS
 import numpy as np
-from PIL import Image
-from pdf2image import convert_from_bytes
+from PIL import Image, ImageDraw
+from pdf2image import convert_from_path, pdfinfo_from_path
 from paddleocr import PaddleOCR
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 import pandas as pd
+from caching import EmbeddingCache, OcrResultCache, embedding_key, normalize_reason, file_digest
+import preprocessing
+from similarity import SimilarityIndex
+from job_store import AnalysisJobStore
+from student_history import StudentHistory, student_key, parse_letter_date, letter_hash
+from embedding_backends import load_backend, parity_check
+from metrics import metrics, stage_timer, timed_stage, collect_timings, begin_timings, end_timings
 
 app = Flask(__name__)
 CORS(app)
 
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+# Inference backend: torch, torch-int8, onnx or onnx-int8 (see embedding_backends.py)
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch')
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 64))
+# Compare a non-torch backend with the float32 model at load, refusing it below this cosine similarity
+EMBEDDING_PARITY_CHECK = os.environ.get('EMBEDDING_PARITY_CHECK', '').lower() in ('1', 'true', 'yes')
+EMBEDDING_PARITY_MIN = float(os.environ.get('EMBEDDING_PARITY_MIN', 0.99))
+# Identifies the vectors in caches and backfills; backends other than torch give slightly different ones
+EMBEDDING_MODEL_ID = EMBEDDING_MODEL_NAME if EMBEDDING_BACKEND == 'torch' else f'{EMBEDDING_MODEL_NAME}+{EMBEDDING_BACKEND}'
+
+# On-disk caches live next to the service unless configured otherwise
+CACHE_DIR = os.environ.get('ATTENDANCE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+
+# Set EMBEDDING_CACHE_PATH to an empty string to keep the embedding cache in memory only
+embedding_cache = EmbeddingCache(
+    os.environ.get('EMBEDDING_CACHE_PATH', os.path.join(CACHE_DIR, 'embeddings.sqlite')),
+    max_memory_items=int(os.environ.get('EMBEDDING_CACHE_MEMORY_ITEMS', 20000))
+)
+
+# Set OCR_CACHE_PATH to an empty string to disable caching of OCR results
+ocr_cache = OcrResultCache(
+    os.environ.get('OCR_CACHE_PATH', os.path.join(CACHE_DIR, 'ocr_results.sqlite')),
+    max_bytes=int(os.environ.get('OCR_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+)
+
+# Past letters per student, so repeats are found across requests;
+# set STUDENT_HISTORY_PATH to an empty string to disable
+student_history = StudentHistory(
+    os.environ.get('STUDENT_HISTORY_PATH', os.path.join(CACHE_DIR, 'student_history.sqlite')),
+    EMBEDDING_MODEL_ID
+)
+# "HISTORY_MIN_SIMILAR or more similar excuses within HISTORY_WINDOW_DAYS days"
+HISTORY_WINDOW_DAYS = int(os.environ.get('HISTORY_WINDOW_DAYS', 30))
+HISTORY_MIN_SIMILAR = int(os.environ.get('HISTORY_MIN_SIMILAR', 3))
+
+# Datasets written by backfill.py; the analyze endpoint loads them by name
+BACKFILL_DIR = os.environ.get('BACKFILL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backfill'))
+BACKFILL_LETTERS_FILE = 'letters.jsonl'
+BACKFILL_EMBEDDINGS_FILE = 'embeddings.npy'
+BACKFILL_META_FILE = 'meta.json'
+
+# Bump when extract_leave_letter_data changes so cached structured output is recomputed
+EXTRACTOR_VERSION = 2
+
+# Clustering: batches of CLUSTER_AUTO_K_MIN+ letters pick k by silhouette score (up to CLUSTER_MAX_K),
+# and CLUSTER_MINIBATCH_MIN+ letters use MiniBatchKMeans
+CLUSTER_AUTO_K_MIN = int(os.environ.get('CLUSTER_AUTO_K_MIN', 50))
+CLUSTER_MINIBATCH_MIN = int(os.environ.get('CLUSTER_MINIBATCH_MIN', 2000))
+CLUSTER_MAX_K = int(os.environ.get('CLUSTER_MAX_K', 10))
+CLUSTER_SILHOUETTE_SAMPLE = int(os.environ.get('CLUSTER_SILHOUETTE_SAMPLE', 2000))
+CLUSTER_SEARCH_THREADS = int(os.environ.get('CLUSTER_SEARCH_THREADS', min(4, os.cpu_count() or 1)))
+
+# Rows of the similarity matrix computed per matrix product when searching for near-duplicates
+SIMILARITY_BLOCK_SIZE = int(os.environ.get('SIMILARITY_BLOCK_SIZE', 512))
+# Storage of the normalized embeddings analyses and sessions compare (float32 or float16); batches and
+# sessions of SIMILARITY_MMAP_MIN_LETTERS+ letters keep them in a memory-mapped temp file under SIMILARITY_MMAP_DIR
+SIMILARITY_DTYPE = os.environ.get('SIMILARITY_DTYPE', 'float32')
+SIMILARITY_MMAP_MIN_LETTERS = int(os.environ.get('SIMILARITY_MMAP_MIN_LETTERS', 20000))
+SIMILARITY_MMAP_DIR = os.environ.get('SIMILARITY_MMAP_DIR') or None
+
+# Batch OCR runs in worker processes, each with its own PaddleOCR instance
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', os.cpu_count() or 1))
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 100))
+# Threads used by one PaddleOCR instance; when unset, the in-process engine uses the whole
+# thread budget and each OCR pool process an equal share of it
+OCR_CPU_THREADS = int(os.environ['OCR_CPU_THREADS']) if os.environ.get('OCR_CPU_THREADS') else None
+# Threads this process may use in total: the per-worker split from gunicorn.conf.py, else every core
+CPU_THREAD_BUDGET = int(os.environ.get('OMP_NUM_THREADS') or os.cpu_count() or 1)
+
+# Page preprocessing before OCR: off, fast, balanced or accurate (see preprocessing.QUALITY_PRESETS)
+OCR_QUALITY = os.environ.get('OCR_QUALITY', 'balanced')
+preprocessing.preset(OCR_QUALITY)  # fail fast on an unknown preset
+
+# PDF rasterization: resolution, page limit (0 = all pages) and pages rendered ahead of OCR
+PDF_DPI = int(os.environ.get('PDF_DPI', 200))
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', 0))
+PDF_PREFETCH_PAGES = int(os.environ.get('PDF_PREFETCH_PAGES', 1))
+
+# Background analysis jobs: executor threads, and how many finished jobs (and MB of their results)
+# to remember. Job state is shared by all server workers through ANALYSIS_JOB_DB_PATH
+# (an empty string keeps it in this process only)
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', 2))
+ANALYSIS_JOB_HISTORY = int(os.environ.get('ANALYSIS_JOB_HISTORY', 100))
+ANALYSIS_JOB_RESULT_MAX_MB = float(os.environ.get('ANALYSIS_JOB_RESULT_MAX_MB', 256))
+ANALYSIS_JOB_DB_PATH = os.environ.get('ANALYSIS_JOB_DB_PATH', os.path.join(CACHE_DIR, 'analysis_jobs.sqlite'))
+
+# Incremental analysis sessions: how many to keep, and when a new letter starts its own category
+ANALYSIS_SESSION_LIMIT = int(os.environ.get('ANALYSIS_SESSION_LIMIT', 50))
+SESSION_NEW_CATEGORY_SIMILARITY = float(os.environ.get('SESSION_NEW_CATEGORY_SIMILARITY', 0.5))
+SESSION_MAX_CATEGORIES = int(os.environ.get('SESSION_MAX_CATEGORIES', 10))
+
+# Models loaded in the background at startup ("all", "none" or a comma list of ocr,embedding)
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', 'all')
+PRELOAD_WARMUP = os.environ.get('PRELOAD_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+
+# Binary uploads are buffered in memory up to this size, then spooled to a temp file
+UPLOAD_SPOOL_MAX_MEMORY = int(os.environ.get('UPLOAD_SPOOL_MAX_MEMORY', 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Opt-in profiling: fraction of requests run under cProfile, and the latency above which their stats are kept
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS', 1000))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
 # Initialize models (lazy loading)
 ocr_engine = None
 embedding_model = None
+model_locks = {'ocr': threading.Lock(), 'embedding': threading.Lock()}
+model_status = {
+    name: {'state': 'not_loaded', 'load_seconds': None, 'warmup_seconds': None, 'error': None}
+    for name in model_locks
+}
+ocr_pool = None
+ocr_pool_lock = threading.Lock()
+analysis_executor = None
+analysis_executor_lock = threading.Lock()
+analysis_jobs = AnalysisJobStore(
+    ANALYSIS_JOB_DB_PATH, history=ANALYSIS_JOB_HISTORY,
+    max_result_bytes=int(ANALYSIS_JOB_RESULT_MAX_MB * 1024 * 1024)
+)
+# Sessions and centroids stay in process memory: with several server workers each has its own
+analysis_sessions: 'OrderedDict[str, AnalysisSession]' = OrderedDict()
+analysis_sessions_lock = threading.Lock()
+# Centroids of the last clustering per class, used to warm-start the next run
+class_centroids: Dict[str, np.ndarray] = {}
+class_centroids_lock = threading.Lock()
+
+def _timed_load(name: str, loader: Callable[[], Any]) -> Any:
+    """Load a model, recording its state and load time for the readiness probe"""
+    status = model_status[name]
+    status.update({'state': 'loading', 'error': None})
+    started = time.perf_counter()
+    try:
+        model = loader()
+    except Exception as e:
+        status.update({'state': 'failed', 'error': str(e)})
+        raise
+    status.update({'state': 'loaded', 'load_seconds': round(time.perf_counter() - started, 3)})
+    return model
 
 def get_ocr_engine():
     """Lazy load OCR engine"""
     global ocr_engine
     if ocr_engine is None:
-        print("Initializing PaddleOCR...")
-        ocr_engine = PaddleOCR(
-            use_angle_cls=True,
-            lang='en',
-            use_gpu=False,
-            show_log=False
-        )
+        with model_locks['ocr']:
+            if ocr_engine is None:
+                print("Initializing PaddleOCR...")
+                ocr_engine = _timed_load('ocr', lambda: PaddleOCR(
+                    use_angle_cls=True,
+                    lang='en',
+                    use_gpu=False,
+                    show_log=False,
+                    cpu_threads=OCR_CPU_THREADS or CPU_THREAD_BUDGET
+                ))
     return ocr_engine
 
+def _init_ocr_worker(cpu_threads: int):
+    """Warm up the OCR engine once per pool worker"""
+    global OCR_CPU_THREADS
+    OCR_CPU_THREADS = OCR_CPU_THREADS or cpu_threads
+    get_ocr_engine()
+
+def get_ocr_pool() -> ProcessPoolExecutor:
+    """Lazily start the OCR worker pool"""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is None:
+            print(f"Starting OCR worker pool ({OCR_WORKERS} processes)...")
+            # Split this process's thread budget between the pool processes so their
+            # PaddleOCR thread pools don't oversubscribe
+            cpu_threads = max(1, CPU_THREAD_BUDGET // OCR_WORKERS)
+            # Spawn rather than fork: the parent may already hold Paddle/torch thread state
+            ocr_pool = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_ocr_worker,
+                initargs=(cpu_threads,)
+            )
+    return ocr_pool
+
+def reset_ocr_pool():
+    """Drop a pool whose workers died so the next batch starts a fresh one"""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is not None:
+            ocr_pool.shutdown(wait=False, cancel_futures=True)
+            ocr_pool = None
+
+def _load_embedding_backend():
+    """Load EMBEDDING_BACKEND, checking it against the float32 model if asked to"""
+    model = load_backend(EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, CACHE_DIR)
+    if EMBEDDING_PARITY_CHECK and EMBEDDING_BACKEND != 'torch':
+        parity = parity_check(model, load_backend('torch', EMBEDDING_MODEL_NAME, CACHE_DIR))
+        print(f"Embedding backend {EMBEDDING_BACKEND} parity: {parity}")
+        if parity['min_cosine'] < EMBEDDING_PARITY_MIN:
+            raise RuntimeError(
+                f"Embedding backend {EMBEDDING_BACKEND} differs from float32 "
+                f"(min cosine {parity['min_cosine']:.4f} < {EMBEDDING_PARITY_MIN})"
+            )
+    return model
+
 def get_embedding_model():
     """Lazy load Sentence-BERT model"""
     global embedding_model
     if embedding_model is None:
-        print("Loading Sentence-BERT model (all-MiniLM-L6-v2)...")
-        embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        with model_locks['embedding']:
+            if embedding_model is None:
+                print(f"Loading Sentence-BERT model ({EMBEDDING_MODEL_NAME}, {EMBEDDING_BACKEND} backend)...")
+                embedding_model = _timed_load('embedding', _load_embedding_backend)
     return embedding_model
 
-def pdf_to_images(pdf_bytes: bytes) -> List[Image.Image]:
-    """Convert PDF bytes to list of PIL Images"""
+def _warmup_image() -> Image.Image:
+    """Small built-in leave-letter snippet for the OCR warm-up pass"""
+    image = Image.new('RGB', (640, 160), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.text((20, 40), 'Respected Sir, I request leave for two days', fill='black')
+    draw.text((20, 90), 'due to fever. Name: Ravi Kumar Roll No: CS21001', fill='black')
+    return image
+
+WARMUP_SENTENCE = 'I was unable to attend classes yesterday due to high fever.'
+
+def _warm_up(name: str, run: Callable[[], Any]):
+    """Run one inference so lazy initialisation happens before real traffic"""
+    status = model_status[name]
+    status['state'] = 'warming'
+    started = time.perf_counter()
     try:
-        images = convert_from_bytes(pdf_bytes, dpi=200)
-        return images
+        run()
+    except Exception as e:
+        status.update({'state': 'failed', 'error': str(e)})
+        raise
+    status.update({'state': 'ready', 'warmup_seconds': round(time.perf_counter() - started, 3)})
+
+def preloaded_model_names() -> List[str]:
+    """Models named by PRELOAD_MODELS"""
+    value = PRELOAD_MODELS.strip().lower()
+    if value in ('', 'none', 'false', '0'):
+        return []
+    if value in ('all', 'true', '1'):
+        return list(model_locks)
+    return [name.strip() for name in value.split(',') if name.strip() in model_locks]
+
+def preload_models(names: Optional[List[str]] = None, warmup: bool = PRELOAD_WARMUP):
+    """Eagerly load (and optionally warm up) models; failures are recorded, not raised"""
+    names = preloaded_model_names() if names is None else names
+    if 'embedding' in names:
+        try:
+            model = get_embedding_model()
+            if warmup:
+                _warm_up('embedding', lambda: model.encode([WARMUP_SENTENCE]))
+            else:
+                model_status['embedding']['state'] = 'ready'
+        except Exception as e:
+            print(f"Failed to preload embedding model: {e}")
+    if 'ocr' in names:
+        try:
+            get_ocr_engine()
+            if warmup:
+                _warm_up('ocr', lambda: extract_text_with_ocr(_warmup_image()))
+            else:
+                model_status['ocr']['state'] = 'ready'
+        except Exception as e:
+            print(f"Failed to preload OCR engine: {e}")
+
+def start_model_preload() -> Optional[threading.Thread]:
+    """Preload models on a background thread so the server can answer probes meanwhile"""
+    if not preloaded_model_names():
+        return None
+    thread = threading.Thread(target=preload_models, name='model-preload', daemon=True)
+    thread.start()
+    return thread
+
+def iter_pdf_pages(
+    pdf_path: str,
+    dpi: Optional[int] = None,
+    max_pages: Optional[int] = None,
+    prefetch: Optional[int] = None
+) -> Iterator[Image.Image]:
+    """Rasterize a PDF file one page at a time.
+
+    Following pages are rendered on a background thread while the caller
+    works on the current one, so at most prefetch + 1 pages are held in
+    memory regardless of document length.
+    """
+    dpi = dpi or PDF_DPI
+    max_pages = PDF_MAX_PAGES if max_pages is None else max_pages
+    prefetch = max(1, PDF_PREFETCH_PAGES if prefetch is None else prefetch)
+    
+    try:
+        page_count = int(pdfinfo_from_path(pdf_path)['Pages'])
     except Exception as e:
         raise Exception(f"Failed to convert PDF: {str(e)}")
+    if max_pages:
+        page_count = min(page_count, max_pages)
+    
+    def render(page: int) -> List[Image.Image]:
+        with stage_timer('pdf_rasterize'):
+            return convert_from_path(pdf_path, dpi=dpi, first_page=page, last_page=page)
+    
+    def submit(executor: ThreadPoolExecutor, page: int):
+        # Carry the request's timing context over to the render thread
+        return executor.submit(contextvars.copy_context().run, render, page)
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        next_page = 1
+        while next_page <= page_count and len(pending) < prefetch:
+            pending.append(submit(executor, next_page))
+            next_page += 1
+        
+        while pending:
+            try:
+                images = pending.popleft().result()
+            except Exception as e:
+                raise Exception(f"Failed to convert PDF: {str(e)}")
+            if next_page <= page_count:
+                pending.append(submit(executor, next_page))
+                next_page += 1
+            yield from images
+
+def iter_pdf_images(
+    pdf: Union[bytes, BinaryIO],
+    dpi: Optional[int] = None,
+    max_pages: Optional[int] = None
+) -> Iterator[Image.Image]:
+    """Rasterize PDF bytes or a binary file object one page at a time"""
+    # poppler reads from a path; delete=False so it can reopen the file on Windows too
+    pdf_file = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+    try:
+        with pdf_file:
+            if isinstance(pdf, (bytes, bytearray)):
+                pdf_file.write(pdf)
+            else:
+                shutil.copyfileobj(pdf, pdf_file, UPLOAD_CHUNK_SIZE)
+        yield from iter_pdf_pages(pdf_file.name, dpi=dpi, max_pages=max_pages)
+    finally:
+        os.unlink(pdf_file.name)
 
-def extract_text_with_ocr(image: Image.Image) -> str:
-    """Extract text from image using PaddleOCR with table and layout support"""
+def pdf_to_images(
+    pdf_bytes: bytes,
+    dpi: Optional[int] = None,
+    max_pages: Optional[int] = None
+) -> List[Image.Image]:
+    """Convert PDF bytes to list of PIL Images"""
+    return list(iter_pdf_images(pdf_bytes, dpi=dpi, max_pages=max_pages))
+
+@timed_stage('ocr')
+def extract_text_with_ocr(image: Image.Image, quality: Optional[str] = None) -> str:
+    """Extract text from image using PaddleOCR with table and layout support
+
+    The page is first normalized and shrunk per the quality preset (OCR_QUALITY by default).
+    """
     ocr = get_ocr_engine()
     
+    with stage_timer('preprocess'):
+        prepared = preprocessing.preprocess_for_ocr(image, quality or OCR_QUALITY)
+    
     # Convert PIL Image to numpy array
-    img_array = np.array(image)
+    img_array = np.array(prepared)
+    if prepared is not image:
+        prepared.close()
     
     # Run OCR
     result = ocr.ocr(img_array, cls=True)
@@ -78,270 +423,562 @@ def extract_text_with_ocr(image: Image.Image) -> str:
     
     return "\n".join(text_lines)
 
-def clean_text(text: str) -> str:
-    """Clean and normalize OCR output"""
-    # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text)
-    # Remove special characters but keep basic punctuation
-    text = re.sub(r'[^\w\s.,!?;:()\-\']', '', text)
-    # Normalize quotes
-    text = text.replace('"', '"').replace('"', '"')
-    text = text.replace("'", "'").replace("'", "'")
-    return text.strip()
+_WHITESPACE_RE = re.compile(r'\s+')
+_HORIZONTAL_SPACE_RE = re.compile(r'[^\S\n]+')
+_DISALLOWED_CHARS_RE = re.compile(r'[^\w\s.,!?;:()\-\'/]')
 
-def extract_leave_letter_data(text: str) -> Dict[str, Any]:
-    """Extract structured data from leave letter text"""
-    # Normalize text for extraction
-    text_lower = text.lower()
-    
-    # Extract student name (look for patterns like "Name:", "I, [Name]", "Student Name:")
-    name_patterns = [
-        r'(?:name|student name|name of student)[\s:]+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)+)',
-        r'(?:i|this is to inform)[\s,]+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)+)',
-        r'([A-Z][a-z]+\s+[A-Z][a-z]+)(?:\s+roll|roll\s+no)',
-    ]
-    student_name = None
-    for pattern in name_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            student_name = match.group(1).strip()
-            break
-    
-    # Extract roll number
-    roll_patterns = [
-        r'(?:roll|roll\s+no|roll\s+number|reg\s+no)[\s:]+([A-Z0-9\-]+)',
-        r'([A-Z]{2,}\d{2,}[A-Z0-9]*)',
-    ]
-    roll_number = None
-    for pattern in roll_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            roll_number = match.group(1).strip()
-            break
-    
-    # Extract date
-    date_patterns = [
-        r'(\d{1,2}[-/]\d{1,2}[-/]\d{2,4})',
-        r'(\d{1,2}\s+(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\s+\d{2,4})',
-    ]
-    date_str = None
-    for pattern in date_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+def clean_text(text: str, keep_lines: bool = False) -> str:
+    """Clean and normalize OCR output
+
+    With keep_lines, line breaks survive (blank lines are dropped) so
+    line-based extraction still sees the letter's layout.
+    """
+    # Remove special characters but keep basic punctuation (and slashes, for dates)
+    text = _DISALLOWED_CHARS_RE.sub('', text)
+    if not keep_lines:
+        # Remove extra whitespace
+        return _WHITESPACE_RE.sub(' ', text).strip()
+    lines = (_HORIZONTAL_SPACE_RE.sub(' ', line).strip() for line in text.split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+# Field patterns in order of preference, each with the confidence of a match.
+# Labelled values ("Name: ...") are trusted most; names are matched case-sensitively
+# and never across a line break.
+_NAME_WORDS = r'([A-Z][a-z]+(?:[ \t]+[A-Z][a-z]+)+)'
+NAME_PATTERNS = [
+    (re.compile(r'\b(?i:student[ \t]+name|name[ \t]+of[ \t]+(?:the[ \t]+)?student|name)[ \t]*[:\-]?[ \t]*' + _NAME_WORDS), 0.9),
+    (re.compile(r'\b(?i:i|this[ \t]+is[ \t]+to[ \t]+inform(?:[ \t]+you)?(?:[ \t]+that)?)[ \t,]+' + _NAME_WORDS), 0.6),
+    (re.compile(r'\b([A-Z][a-z]+[ \t]+[A-Z][a-z]+)[ \t,]+(?i:roll)'), 0.5),
+]
+ROLL_PATTERNS = [
+    (re.compile(r'\b(?:roll|reg(?:istration)?)[ \t]*(?:number|num|no)?\.?[ \t]*[:\-]?[ \t]*([A-Z0-9][A-Z0-9\-/]*\d[A-Z0-9\-/]*)',
+                re.IGNORECASE), 0.9),
+    (re.compile(r'\b([A-Z]{2,}\d{2,}[A-Z0-9]*)\b', re.IGNORECASE), 0.5),
+]
+_NUMERIC_DATE = r'\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4}'
+_WORD_DATE = r'\d{1,2}(?:st|nd|rd|th)?[ \t]+(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*,?[ \t]+\d{2,4}'
+DATE_PATTERNS = [
+    (re.compile(rf'\bdate[ \t]*[:\-]?[ \t]*({_NUMERIC_DATE}|{_WORD_DATE})', re.IGNORECASE), 0.9),
+    (re.compile(rf'\b({_NUMERIC_DATE})\b'), 0.7),
+    (re.compile(rf'\b({_WORD_DATE})\b', re.IGNORECASE), 0.7),
+]
+# Lines that start the reason, end it (sign-offs) or are letter headers; salutations are stripped
+REASON_KEYWORDS_RE = re.compile(r'leave|absent|unable|request|permission|due to|because', re.IGNORECASE)
+SIGN_OFF_RE = re.compile(r'respectfully|yours|sincerely|signature|thanking', re.IGNORECASE)
+HEADER_RE = re.compile(r'^(?:to|from|sub(?:ject)?|date|name|roll|reg|ref)\b', re.IGNORECASE)
+SALUTATION_RE = re.compile(r"^(?:respected|dear)(?:[ \t]+(?:sir|madam|ma'?am|principal|teacher))*[ \t]*[,.]?[ \t]*",
+                           re.IGNORECASE)
+REASON_MAX_LINES = 5
+
+def _match_field(text: str, patterns: List[Tuple[re.Pattern, float]]) -> Tuple[Optional[str], float]:
+    """First match of the most preferred pattern, with its confidence"""
+    for pattern, confidence in patterns:
+        match = pattern.search(text)
         if match:
-            date_str = match.group(1).strip()
-            break
-    
-    # Extract leave reason (main text content)
-    # Remove headers, signatures, and common phrases
-    reason_keywords = ['leave', 'absent', 'unable', 'request', 'permission', 'due to', 'because']
-    lines = text.split('\n')
+            return match.group(1).strip(), confidence
+    return None, 0.0
+
+def _extract_reason(text: str) -> Tuple[str, float]:
+    """Reason paragraph from a line-structured letter, with its confidence"""
     reason_lines = []
-    in_reason_section = False
-    
-    for line in lines:
-        line_lower = line.lower().strip()
-        # Skip empty lines and common headers
-        if not line_lower or len(line_lower) < 10:
-            continue
-        if any(keyword in line_lower for keyword in ['respectfully', 'yours', 'sincerely', 'signature', 'date:', 'name:']):
+    for line in text.split('\n'):
+        line = SALUTATION_RE.sub('', line)
+        # The reason ends at a sign-off, possibly on the same line
+        sign_off = SIGN_OFF_RE.search(line)
+        if sign_off:
+            line = line[:sign_off.start()].strip()
+        # Skip short fragments and headers before the reason; a header after it ends it
+        if len(line) >= 10:
+            if HEADER_RE.match(line):
+                if reason_lines:
+                    break
+            elif reason_lines or REASON_KEYWORDS_RE.search(line):
+                reason_lines.append(line)
+        if sign_off or len(reason_lines) == REASON_MAX_LINES:
             break
-        if any(keyword in line_lower for keyword in reason_keywords):
-            in_reason_section = True
-        if in_reason_section or len(reason_lines) > 0:
-            reason_lines.append(line)
     
-    reason = ' '.join(reason_lines[:5])  # Take first 5 relevant lines
-    if not reason or len(reason) < 20:
-        # Fallback: take middle section of text
-        mid_start = len(text) // 4
-        mid_end = 3 * len(text) // 4
-        reason = text[mid_start:mid_end]
-    
-    reason = clean_text(reason)
+    reason = ' '.join(reason_lines)
+    if len(reason) >= 20:
+        return reason, 0.8
+    # Fallback: take middle section of text
+    flat = text.replace('\n', ' ')
+    reason = flat[len(flat) // 4:3 * len(flat) // 4].strip()
+    return reason, (0.3 if reason else 0.0)
+
+def _extract_fields(text: str) -> Dict[str, Any]:
+    """Single extraction over one letter (see extract_leave_letter_data)"""
+    text = clean_text(text, keep_lines=True)
+    student_name, name_confidence = _match_field(text, NAME_PATTERNS)
+    roll_number, roll_confidence = _match_field(text, ROLL_PATTERNS)
+    date_str, date_confidence = _match_field(text, DATE_PATTERNS)
+    reason, reason_confidence = _extract_reason(text)
     
     return {
         'student_name': student_name,
         'roll_number': roll_number,
         'date': date_str,
         'reason': reason,
+        'confidence': {
+            'student_name': name_confidence,
+            'roll_number': roll_confidence,
+            'date': date_confidence,
+            'reason': reason_confidence
+        },
         'raw_text': text
     }
 
+@timed_stage('extraction')
+def extract_leave_letter_data(text: str) -> Dict[str, Any]:
+    """Extract structured data from leave letter text
+
+    The text is cleaned once, keeping its lines; each field comes with a
+    0-1 confidence (0 when it wasn't found).
+    """
+    return _extract_fields(text)
+
+@timed_stage('extraction')
+def extract_leave_letters_data(texts: List[str]) -> List[Dict[str, Any]]:
+    """extract_leave_letter_data over many texts, e.g. for backfills"""
+    return [_extract_fields(text) for text in texts]
+
+@timed_stage('embedding')
 def compute_embeddings(reasons: List[str]) -> np.ndarray:
-    """Compute semantic embeddings for leave reasons"""
-    model = get_embedding_model()
-    embeddings = model.encode(reasons, show_progress_bar=False)
-    return embeddings
+    """Compute semantic embeddings for leave reasons, encoding only reasons not seen before"""
+    texts = [normalize_reason(reason) for reason in reasons]
+    keys = [embedding_key(text, EMBEDDING_MODEL_ID) for text in texts]
+    vectors = embedding_cache.get_many(keys)
+    
+    # Encode each uncached reason once, even if it repeats within the batch
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+            missing[key] = text
+    
+    if missing:
+        model = get_embedding_model()
+        with stage_timer('embedding_model'):
+            encoded = model.encode(list(missing.values()), batch_size=EMBEDDING_BATCH_SIZE)
+        fresh = dict(zip(missing.keys(), encoded))
+        embedding_cache.put_many(fresh)
+        vectors.update(fresh)
+    
+    return np.array([vectors[key] for key in keys], dtype=np.float32)
+
+def _make_kmeans(n_clusters: int, n_samples: int, init: Any = 'k-means++', n_init: int = 3):
+    """KMeans, or MiniBatchKMeans for large batches"""
+    if n_samples >= CLUSTER_MINIBATCH_MIN:
+        return MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=n_init, batch_size=1024, random_state=42)
+    return KMeans(n_clusters=n_clusters, init=init, n_init=n_init, random_state=42)
+
+def _score_k(normalized: np.ndarray, n_clusters: int) -> Tuple[float, np.ndarray, np.ndarray]:
+    """Fit k clusters and score them with a sampled silhouette"""
+    model = _make_kmeans(n_clusters, len(normalized))
+    labels = model.fit_predict(normalized)
+    # Sample as silhouette_score(sample_size=..., random_state=42) would, but check the sampled
+    # labels: a small cluster can be missing from the sample, leaving too few labels to score
+    sample = np.random.RandomState(42).permutation(len(normalized))[:CLUSTER_SILHOUETTE_SAMPLE]
+    sample_labels = labels[sample]
+    if not 2 <= len(np.unique(sample_labels)) <= len(sample) - 1:
+        return -1.0, labels, model.cluster_centers_
+    score = silhouette_score(normalized[sample], sample_labels)
+    return float(score), labels, model.cluster_centers_
+
+@timed_stage('clustering')
+def cluster_reasons(
+    embeddings: np.ndarray,
+    n_clusters: Optional[int] = None,
+    class_id: Optional[str] = None
+) -> np.ndarray:
+    """Cluster similar leave reasons using KMeans
 
-def cluster_reasons(embeddings: np.ndarray, n_clusters: Optional[int] = None) -> np.ndarray:
-    """Cluster similar leave reasons using KMeans"""
+    Small batches (and any batch too small for a silhouette score) keep
+    the original heuristic. Larger ones cluster the
+    L2-normalized embeddings (so distances follow cosine similarity),
+    choose k by silhouette score with candidates fitted in parallel,
+    and warm-start from the previous centroids of the same class.
+    """
     if len(embeddings) < 2:
         return np.array([0] * len(embeddings))
     
-    # Determine optimal number of clusters
-    if n_clusters is None:
-        n_clusters = min(max(2, len(embeddings) // 3), 10)
+    # The silhouette needs 2 to n - 1 labels, so auto-k needs at least 3 letters
+    if len(embeddings) < 3 or (len(embeddings) < CLUSTER_AUTO_K_MIN and class_id is None):
+        # Determine optimal number of clusters
+        if n_clusters is None:
+            n_clusters = min(max(2, len(embeddings) // 3), 10)
+        
+        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+        clusters = kmeans.fit_predict(embeddings)
+        return clusters
+    
+    normalized = normalize(embeddings)
+    with class_centroids_lock:
+        previous = class_centroids.get(class_id) if class_id is not None else None
+    
+    if n_clusters is None and previous is not None and previous.shape[1] == normalized.shape[1] \
+            and len(previous) <= len(normalized):
+        # Same class as before: start from last run's centroids, one init is enough
+        model = _make_kmeans(len(previous), len(normalized), init=previous, n_init=1)
+        labels = model.fit_predict(normalized)
+        centers = model.cluster_centers_
+    elif n_clusters is not None:
+        model = _make_kmeans(min(n_clusters, len(normalized)), len(normalized))
+        labels = model.fit_predict(normalized)
+        centers = model.cluster_centers_
+    else:
+        candidates = range(2, min(CLUSTER_MAX_K, len(normalized) - 1) + 1)
+        with ThreadPoolExecutor(max_workers=CLUSTER_SEARCH_THREADS) as executor:
+            scored = list(executor.map(lambda k: _score_k(normalized, k), candidates))
+        # Highest silhouette wins; ties go to the smaller k
+        _, labels, centers = max(scored, key=lambda result: result[0])
     
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-    clusters = kmeans.fit_predict(embeddings)
-    return clusters
+    if class_id is not None:
+        with class_centroids_lock:
+            class_centroids[class_id] = np.asarray(centers, dtype=np.float32)
+    return labels
 
+@timed_stage('similarity_matrix')
 def compute_similarity_matrix(embeddings: np.ndarray) -> np.ndarray:
     """Compute pairwise cosine similarity matrix"""
     return cosine_similarity(embeddings)
 
+@timed_stage('similarity_index')
+def build_similarity_index(embeddings: np.ndarray) -> SimilarityIndex:
+    """Compact similarity index over the embeddings, instead of a dense n x n matrix"""
+    return SimilarityIndex(
+        embeddings,
+        dtype=SIMILARITY_DTYPE,
+        mmap=len(embeddings) >= SIMILARITY_MMAP_MIN_LETTERS,
+        mmap_dir=SIMILARITY_MMAP_DIR,
+        block_size=SIMILARITY_BLOCK_SIZE
+    )
+
+def _student_summary(letter: Dict[str, Any]) -> Dict[str, Any]:
+    """Student fields attached to pairwise anomalies"""
+    return {
+        'name': letter.get('student_name', 'Unknown'),
+        'roll_number': letter.get('roll_number', 'N/A'),
+        'date': letter.get('date', 'N/A'),
+        'reason': letter.get('reason', '')[:100]
+    }
+
+HIGH_SIMILARITY_THRESHOLD = 0.85
+MEDIUM_SIMILARITY_THRESHOLD = 0.75
+LARGE_GROUP_MIN_SIZE = 5
+VAGUE_KEYWORDS = ['personal', 'urgent', 'important', 'necessary', 'unavoidable', 'circumstances']
+GENERIC_PHRASES = ['due to personal reasons', 'due to unavoidable circumstances', 'urgent work']
+
+def _student_key(letter: Dict[str, Any]) -> Any:
+    """Identify a student by roll number, falling back to name"""
+    return letter.get('roll_number') or letter.get('student_name', 'unknown')
+
+def _high_similarity_anomaly(
+    first: Dict[str, Any],
+    second: Dict[str, Any],
+    similarity: float
+) -> Dict[str, Any]:
+    """Two students submitted near-identical reasons"""
+    return {
+        'type': 'high_similarity',
+        'risk_level': 'high',
+        'description': f'Leave reasons are highly similar (similarity: {similarity:.2f})',
+        'students': [first, second],
+        'similarity_score': similarity
+    }
+
+def _repeated_excuse_anomaly(
+    leave_letters: List[Dict[str, Any]],
+    student_id: Any,
+    indices: List[int],
+    similarity: Callable[[int, int], float]
+) -> Optional[Dict[str, Any]]:
+    """Flag a student with several leave requests, or two similar ones"""
+    if len(indices) < 2:
+        return None
+    
+    student = {
+        'name': leave_letters[indices[0]].get('student_name', 'Unknown'),
+        'roll_number': student_id
+    }
+    if len(indices) == 2:
+        # Check if reasons are similar
+        pair_similarity = similarity(indices[0], indices[1])
+        if pair_similarity < MEDIUM_SIMILARITY_THRESHOLD:
+            return None
+        return {
+            'type': 'repeated_excuse',
+            'risk_level': 'medium',
+            'description': f'Student submitted {len(indices)} similar leave requests',
+            'student': student,
+            'excuses': [
+                {
+                    'date': leave_letters[i].get('date', 'N/A'),
+                    'reason': leave_letters[i].get('reason', '')[:100]
+                }
+                for i in indices
+            ],
+            'similarity_score': float(pair_similarity)
+        }
+    
+    return {
+        'type': 'repeated_excuse',
+        'risk_level': 'high',
+        'description': f'Student submitted {len(indices)} leave requests',
+        'student': student,
+        'excuse_count': len(indices)
+    }
+
+def _recurring_excuse_anomaly(
+    leave_letters: List[Dict[str, Any]],
+    indices: List[int],
+    previous: List[Dict[str, Any]],
+    similarities: List[float]
+) -> Dict[str, Any]:
+    """A letter resembles earlier letters from the same student within the history window
+
+    indices are the similar letters of this request (the anchor letter first),
+    previous the similar stored letters, and similarities the previous letters' scores.
+    """
+    anchor = leave_letters[indices[0]]
+    count = len(indices) + len(previous)
+    excuses = [
+        {'date': leave_letters[i].get('date', 'N/A'), 'reason': leave_letters[i].get('reason', '')[:100], 'previous': False}
+        for i in indices
+    ] + [
+        {'date': entry['date'] or 'N/A', 'reason': entry['reason'][:100], 'previous': True, 'similarity_score': score}
+        for entry, score in zip(previous, similarities)
+    ]
+    return {
+        'type': 'recurring_excuse',
+        'risk_level': 'high',
+        'description': f'Student submitted {count} similar leave requests within {HISTORY_WINDOW_DAYS} days',
+        'student': {
+            'name': anchor.get('student_name', 'Unknown'),
+            'roll_number': _student_key(anchor)
+        },
+        'excuses': excuses,
+        'previous_count': len(previous),
+        'window_days': HISTORY_WINDOW_DAYS
+    }
+
+def history_entries(leave_letters: List[Dict[str, Any]], index: SimilarityIndex) -> List[Optional[Dict[str, Any]]]:
+    """student_history rows for the letters (None for letters without a student), in letter order"""
+    entries = []
+    for idx, letter in enumerate(leave_letters):
+        key = student_key(letter.get('roll_number') or letter.get('student_name'))
+        if key is None:
+            entries.append(None)
+            continue
+        entries.append({
+            'student_key': key,
+            'letter_hash': letter_hash(key, letter.get('date'), letter.get('reason')),
+            'day': parse_letter_date(letter.get('date')),
+            'date': letter.get('date'),
+            'student_name': letter.get('student_name'),
+            'reason': letter.get('reason') or '',
+            'vector': np.asarray(index.vectors[idx], dtype=np.float32)
+        })
+    return entries
+
+def _densest_window(days: List[int], anchor_day: int, previous: List[bool]) -> List[int]:
+    """Positions of the largest set of days spanning at most HISTORY_WINDOW_DAYS that includes
+    anchor_day, preferring sets with at least one previous letter"""
+    best, best_rank = [], (False, 0)
+    # Some optimal window starts at one of the days, no earlier than a window before the anchor
+    for start in sorted({day for day in days if anchor_day - HISTORY_WINDOW_DAYS <= day <= anchor_day}):
+        members = [pos for pos, day in enumerate(days) if start <= day <= start + HISTORY_WINDOW_DAYS]
+        rank = (any(previous[pos] for pos in members), len(members))
+        if rank > best_rank:
+            best, best_rank = members, rank
+    return best
+
+def iter_history_anomalies(
+    leave_letters: List[Dict[str, Any]],
+    index: SimilarityIndex,
+    entries: List[Optional[Dict[str, Any]]]
+) -> Iterator[Dict[str, Any]]:
+    """Compare each dated letter with the same student's stored letters around its date
+
+    Flags a student (once, at their worst letter) when at least HISTORY_MIN_SIMILAR letters
+    similar to it, itself included, fall within a single HISTORY_WINDOW_DAYS span and at least
+    one of them came from an earlier request; repeats within this request alone are the
+    repeated_excuse check's job.
+    """
+    batch_hashes = {entry['letter_hash'] for entry in entries if entry is not None}
+    student_letters = {}
+    for idx, entry in enumerate(entries):
+        if entry is not None and entry['day'] is not None:
+            student_letters.setdefault(entry['student_key'], []).append(idx)
+    
+    for key, indices in student_letters.items():
+        best = None
+        for idx in indices:
+            day = entries[idx]['day']
+            stored = student_history.nearby(key, day, HISTORY_WINDOW_DAYS, batch_hashes)
+            if not stored:
+                continue
+            scores = [float(entry['vector'] @ entries[idx]['vector']) for entry in stored]
+            previous = [(entry, score) for entry, score in zip(stored, scores) if score >= MEDIUM_SIMILARITY_THRESHOLD]
+            if not previous:
+                continue
+            current = [idx] + [
+                other for other in indices
+                if other != idx and abs(entries[other]['day'] - day) <= HISTORY_WINDOW_DAYS
+                and index.similarity(idx, other) >= MEDIUM_SIMILARITY_THRESHOLD
+            ]
+            # Both lists reach a window either side of the letter; keep one window's worth
+            members = _densest_window(
+                [entries[i]['day'] for i in current] + [entry['day'] for entry, _ in previous],
+                day,
+                [False] * len(current) + [True] * len(previous)
+            )
+            split = len(current)
+            current = [current[pos] for pos in members if pos < split]
+            previous = [previous[pos - split] for pos in members if pos >= split]
+            if previous and len(current) + len(previous) >= HISTORY_MIN_SIMILAR and (
+                best is None or len(current) + len(previous) > len(best[0]) + len(best[1])
+            ):
+                best = (current, previous)
+        if best is not None:
+            current, previous = best
+            yield _recurring_excuse_anomaly(
+                leave_letters, current, [entry for entry, _ in previous], [score for _, score in previous]
+            )
+
+def record_history(entries: List[Optional[Dict[str, Any]]]) -> int:
+    """Add the analyzed letters to the student history (already stored ones are skipped)"""
+    try:
+        return student_history.record(entry for entry in entries if entry is not None)
+    except sqlite3.Error as e:
+        print(f"Failed to record student history: {e}")
+        return 0
+
+def _large_group_anomaly(
+    leave_letters: List[Dict[str, Any]],
+    date: Any,
+    indices: List[int],
+    average_similarity: float
+) -> Dict[str, Any]:
+    """Many students gave the same kind of reason for the same date"""
+    return {
+        'type': 'large_group',
+        'risk_level': 'high',
+        'description': f'{len(indices)} students submitted similar leave reasons on {date}',
+        'date': str(date),
+        'student_count': len(indices),
+        'students': [
+            {
+                'name': leave_letters[i].get('student_name', 'Unknown'),
+                'roll_number': leave_letters[i].get('roll_number', 'N/A')
+            }
+            for i in indices
+        ],
+        'average_similarity': float(average_similarity),
+        'representative_reason': leave_letters[indices[0]].get('reason', '')[:150]
+    }
+
+def _vague_reason_anomaly(letter: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Flag a short, vague or boilerplate reason"""
+    reason = letter.get('reason', '').lower()
+    vague_count = sum(1 for keyword in VAGUE_KEYWORDS if keyword in reason)
+    is_generic = any(phrase in reason for phrase in GENERIC_PHRASES)
+    
+    if vague_count >= 2 or is_generic or len(reason) < 30:
+        return {
+            'type': 'vague_reason',
+            'risk_level': 'low',
+            'description': 'Leave reason is vague or generic',
+            'student': {
+                'name': letter.get('student_name', 'Unknown'),
+                'roll_number': letter.get('roll_number', 'N/A'),
+                'date': letter.get('date', 'N/A')
+            },
+            'reason': letter.get('reason', '')[:150],
+            'vague_keyword_count': vague_count,
+            'is_generic': is_generic
+        }
+    return None
+
+@timed_stage('anomalies')
 def detect_anomalies(
     leave_letters: List[Dict[str, Any]],
-    embeddings: np.ndarray,
-    similarity_matrix: np.ndarray,
-    clusters: np.ndarray
+    index: SimilarityIndex,
+    clusters: np.ndarray,
+    history: Optional[List[Optional[Dict[str, Any]]]] = None
 ) -> List[Dict[str, Any]]:
     """Detect attendance anomalies"""
-    anomalies = []
-    threshold_high_similarity = 0.85
-    threshold_medium_similarity = 0.75
-    
+    return list(iter_anomalies(leave_letters, index, clusters, history))
+
+def iter_anomalies(
+    leave_letters: List[Dict[str, Any]],
+    index: SimilarityIndex,
+    clusters: np.ndarray,
+    history: Optional[List[Optional[Dict[str, Any]]]] = None
+) -> Iterator[Dict[str, Any]]:
+    """Yield attendance anomalies as each check finds them
+
+    history, the letters' history_entries, also compares them with the student history.
+    """
     # 1. Detect highly similar or copied leave reasons
-    for i in range(len(leave_letters)):
-        for j in range(i + 1, len(leave_letters)):
-            similarity = similarity_matrix[i][j]
-            if similarity >= threshold_high_similarity:
-                anomalies.append({
-                    'type': 'high_similarity',
-                    'risk_level': 'high',
-                    'description': f'Leave reasons are highly similar (similarity: {similarity:.2f})',
-                    'students': [
-                        {
-                            'name': leave_letters[i].get('student_name', 'Unknown'),
-                            'roll_number': leave_letters[i].get('roll_number', 'N/A'),
-                            'date': leave_letters[i].get('date', 'N/A'),
-                            'reason': leave_letters[i].get('reason', '')[:100]
-                        },
-                        {
-                            'name': leave_letters[j].get('student_name', 'Unknown'),
-                            'roll_number': leave_letters[j].get('roll_number', 'N/A'),
-                            'date': leave_letters[j].get('date', 'N/A'),
-                            'reason': leave_letters[j].get('reason', '')[:100]
-                        }
-                    ],
-                    'similarity_score': float(similarity)
-                })
+    summaries = {}
+    for i, j, similarity in index.pairs_above(HIGH_SIMILARITY_THRESHOLD):
+        for idx in (i, j):
+            if idx not in summaries:
+                summaries[idx] = _student_summary(leave_letters[idx])
+        yield _high_similarity_anomaly(summaries[i], summaries[j], similarity)
     
     # 2. Detect repeated excuses by same student
-    student_excuses = {}
+    student_letters = {}
     for idx, letter in enumerate(leave_letters):
-        student_id = letter.get('roll_number') or letter.get('student_name', 'unknown')
-        if student_id not in student_excuses:
-            student_excuses[student_id] = []
-        student_excuses[student_id].append({
-            'index': idx,
-            'date': letter.get('date', 'N/A'),
-            'reason': letter.get('reason', '')
-        })
+        student_letters.setdefault(_student_key(letter), []).append(idx)
     
-    for student_id, excuses in student_excuses.items():
-        if len(excuses) >= 2:
-            # Check if reasons are similar
-            if len(excuses) == 2:
-                idx1, idx2 = excuses[0]['index'], excuses[1]['index']
-                similarity = similarity_matrix[idx1][idx2]
-                if similarity >= threshold_medium_similarity:
-                    anomalies.append({
-                        'type': 'repeated_excuse',
-                        'risk_level': 'medium',
-                        'description': f'Student submitted {len(excuses)} similar leave requests',
-                        'student': {
-                            'name': leave_letters[excuses[0]['index']].get('student_name', 'Unknown'),
-                            'roll_number': student_id
-                        },
-                        'excuses': [
-                            {'date': e['date'], 'reason': e['reason'][:100]} 
-                            for e in excuses
-                        ],
-                        'similarity_score': float(similarity)
-                    })
-            else:
-                anomalies.append({
-                    'type': 'repeated_excuse',
-                    'risk_level': 'high',
-                    'description': f'Student submitted {len(excuses)} leave requests',
-                    'student': {
-                        'name': leave_letters[excuses[0]['index']].get('student_name', 'Unknown'),
-                        'roll_number': student_id
-                    },
-                    'excuse_count': len(excuses)
-                })
+    for student_id, indices in student_letters.items():
+        anomaly = _repeated_excuse_anomaly(
+            leave_letters, student_id, indices, index.similarity
+        )
+        if anomaly:
+            yield anomaly
+    
+    # 2b. Detect excuses repeated across requests, from the student history
+    if history is not None:
+        yield from iter_history_anomalies(leave_letters, index, history)
     
     # 3. Detect unusually large groups sharing same reason on same date
     date_groups = {}
     for idx, letter in enumerate(leave_letters):
-        date = letter.get('date', 'unknown')
-        cluster_id = int(clusters[idx])
-        key = f"{date}_{cluster_id}"
-        if key not in date_groups:
-            date_groups[key] = []
-        date_groups[key].append(idx)
-    
-    for key, indices in date_groups.items():
-        if len(indices) >= 5:  # 5 or more students with similar reason on same date
-            date, cluster_id = key.split('_')
-            cluster_reasons_list = [leave_letters[i].get('reason', '') for i in indices]
-            avg_similarity = np.mean([
-                similarity_matrix[i][j] 
-                for i in indices 
-                for j in indices 
-                if i < j
-            ]) if len(indices) > 1 else 1.0
-            
-            anomalies.append({
-                'type': 'large_group',
-                'risk_level': 'high',
-                'description': f'{len(indices)} students submitted similar leave reasons on {date}',
-                'date': date,
-                'student_count': len(indices),
-                'students': [
-                    {
-                        'name': leave_letters[i].get('student_name', 'Unknown'),
-                        'roll_number': leave_letters[i].get('roll_number', 'N/A')
-                    }
-                    for i in indices
-                ],
-                'average_similarity': float(avg_similarity),
-                'representative_reason': cluster_reasons_list[0][:150] if cluster_reasons_list else ''
-            })
+        key = (letter.get('date', 'unknown'), int(clusters[idx]))
+        date_groups.setdefault(key, []).append(idx)
     
-    # 4. Detect vague or generic reasons
-    vague_keywords = ['personal', 'urgent', 'important', 'necessary', 'unavoidable', 'circumstances']
-    generic_phrases = ['due to personal reasons', 'due to unavoidable circumstances', 'urgent work']
+    for (date, cluster_id), indices in date_groups.items():
+        if len(indices) >= LARGE_GROUP_MIN_SIZE:
+            avg_similarity = index.mean_similarity(indices)
+            yield _large_group_anomaly(leave_letters, date, indices, avg_similarity)
     
-    for idx, letter in enumerate(leave_letters):
-        reason = letter.get('reason', '').lower()
-        vague_count = sum(1 for keyword in vague_keywords if keyword in reason)
-        is_generic = any(phrase in reason for phrase in generic_phrases)
-        
-        if vague_count >= 2 or is_generic or len(reason) < 30:
-            anomalies.append({
-                'type': 'vague_reason',
-                'risk_level': 'low',
-                'description': 'Leave reason is vague or generic',
-                'student': {
-                    'name': letter.get('student_name', 'Unknown'),
-                    'roll_number': letter.get('roll_number', 'N/A'),
-                    'date': letter.get('date', 'N/A')
-                },
-                'reason': letter.get('reason', '')[:150],
-                'vague_keyword_count': vague_count,
-                'is_generic': is_generic
-            })
-    
-    return anomalies
+    # 4. Detect vague or generic reasons
+    for letter in leave_letters:
+        anomaly = _vague_reason_anomaly(letter)
+        if anomaly:
+            yield anomaly
+
+RISK_LEVELS = ('high', 'medium', 'low')
 
+def count_risk_levels(
+    anomalies: Iterable[Dict[str, Any]],
+    counts: Optional[Dict[str, int]] = None
+) -> Dict[str, int]:
+    """Number of anomalies at each risk level, added to counts when given"""
+    counts = dict.fromkeys(RISK_LEVELS, 0) if counts is None else counts
+    for anomaly in anomalies:
+        if anomaly.get('risk_level') in counts:
+            counts[anomaly['risk_level']] += 1
+    return counts
+
+@timed_stage('insights')
 def generate_insights(
     leave_letters: List[Dict[str, Any]],
     clusters: np.ndarray,
-    anomalies: List[Dict[str, Any]]
+    risk_counts: Dict[str, int]
 ) -> List[str]:
-    """Generate AI-powered insights"""
+    """Generate AI-powered insights (risk_counts as returned by count_risk_levels)"""
     insights = []
     
     # Cluster statistics
@@ -350,9 +987,9 @@ def generate_insights(
     insights.append(f"Analyzed {total_letters} leave letters and identified {unique_clusters} distinct reason categories.")
     
     # Anomaly summary
-    high_risk = sum(1 for a in anomalies if a.get('risk_level') == 'high')
-    medium_risk = sum(1 for a in anomalies if a.get('risk_level') == 'medium')
-    low_risk = sum(1 for a in anomalies if a.get('risk_level') == 'low')
+    high_risk = risk_counts['high']
+    medium_risk = risk_counts['medium']
+    low_risk = risk_counts['low']
     
     if high_risk > 0:
         insights.append(f"⚠️ {high_risk} high-risk anomalies detected requiring immediate review.")
@@ -387,148 +1024,903 @@ def health():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'service': 'attendance-analysis'})
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe: 503 until every preloaded model is loaded and warmed up"""
+    required = preloaded_model_names()
+    is_ready = all(model_status[name]['state'] == 'ready' for name in required)
+    return jsonify({
+        'ready': is_ready,
+        'required_models': required,
+        'models': model_status
+    }), 200 if is_ready else 503
+
+def _wants_timings() -> bool:
+    """Timings are added to JSON responses on ?timings=true or "include_timings": true"""
+    if request.args.get('timings') == 'true':
+        return True
+    data = request.get_json(silent=True) if request.is_json else None
+    return isinstance(data, dict) and bool(data.get('include_timings'))
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.timings, g.timings_token = begin_timings()
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profiler = profiler
+        except ValueError:
+            # Another request on this interpreter is already being profiled
+            pass
+
+def _save_profile(profiler: cProfile.Profile, elapsed_ms: float):
+    """Log (and optionally dump) the profile of a slow request"""
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(25)
+    print(f"Slow request {request.method} {request.path} took {elapsed_ms:.0f}ms\n{stream.getvalue()}")
+    if PROFILE_DIR:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{request.endpoint or 'unknown'}.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+
+@app.after_request
+def _record_request_metrics(response: Response) -> Response:
+    elapsed = time.perf_counter() - g.request_started
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        if elapsed * 1000 >= PROFILE_SLOW_REQUEST_MS:
+            try:
+                _save_profile(profiler, elapsed * 1000)
+            except Exception as e:
+                print(f"Failed to save request profile: {e}")
+    
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('attendance_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.observe('attendance_request_duration_seconds', elapsed, endpoint=endpoint)
+    if request.content_length:
+        metrics.observe('attendance_request_size_bytes', request.content_length, endpoint=endpoint)
+    
+    if not response.is_streamed:
+        if response.is_json and _wants_timings():
+            payload = response.get_json()
+            if isinstance(payload, dict):
+                payload['timings'] = {
+                    'total_ms': round(elapsed * 1000, 3),
+                    'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in g.timings.items()}
+                }
+                response.set_data(app.json.dumps(payload))
+        metrics.observe('attendance_response_size_bytes', response.calculate_content_length() or 0, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def _end_request_metrics(error: Optional[BaseException] = None):
+    token = g.pop('timings_token', None)
+    if token is not None:
+        end_timings(token)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus text-format metrics for this process"""
+    cache = embedding_cache.stats()
+    ocr_results = ocr_cache.stats()
+    running_jobs = analysis_jobs.active_count()
+    gauges = {
+        'attendance_embedding_cache_memory_hits': ('Embedding cache hits served from memory', cache['memory_hits']),
+        'attendance_embedding_cache_disk_hits': ('Embedding cache hits served from disk', cache['disk_hits']),
+        'attendance_embedding_cache_misses': ('Reasons that had to be encoded by the model', cache['misses']),
+        'attendance_embedding_cache_hit_ratio': ('Share of embedding lookups served from cache', cache['hit_rate']),
+        'attendance_ocr_cache_hits': ('Uploads served from the OCR result cache', ocr_results['hits']),
+        'attendance_ocr_cache_misses': ('Uploads that had to be OCR\'d', ocr_results['misses']),
+        'attendance_ocr_cache_hit_ratio': ('Share of uploads served from the OCR result cache', ocr_results['hit_rate']),
+        'attendance_analysis_jobs_active': ('Analysis jobs queued or running on any worker', running_jobs),
+    }
+    for name, status in model_status.items():
+        gauges[f'attendance_model_{name}_ready'] = (f'Whether the {name} model is loaded and warmed up', int(status['state'] == 'ready'))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    """Cache hit/miss counters"""
+    return jsonify({
+        'embeddings': embedding_cache.stats(),
+        'ocr_results': ocr_cache.stats(),
+        'student_history': student_history.stats()
+    })
+
+def decode_file_data(file_data: str) -> bytes:
+    """Decode a base64 file, with or without a data: URL prefix"""
+    if not file_data:
+        raise ValueError('File data required')
+    if file_data.startswith('data:'):
+        file_data = file_data.split(',')[1]
+    return base64.b64decode(file_data)
+
+def spool_request_body() -> BinaryIO:
+    """Copy a raw request body into a spooled temp file without holding it all in memory"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY)
+    shutil.copyfileobj(request.stream, spooled, UPLOAD_CHUNK_SIZE)
+    spooled.seek(0)
+    return spooled
+
+def ocr_settings() -> str:
+    """Everything besides file content that affects OCR output, for cache keys"""
+    return (f'paddleocr-en-angle;min_confidence=0.5;dpi={PDF_DPI};max_pages={PDF_MAX_PAGES};'
+            f'preprocess={preprocessing.describe(OCR_QUALITY)};extractor={EXTRACTOR_VERSION}')
+
+def process_file(file_obj: BinaryIO) -> Dict[str, Any]:
+    """OCR and extract a seekable file object, serving repeated uploads from the OCR cache"""
+    key = OcrResultCache.key(file_digest(file_obj), ocr_settings())
+    cached = ocr_cache.get(key)
+    if cached is not None:
+        return {**cached, 'cached': True}
+    
+    result = run_ocr_pipeline(file_obj)
+    ocr_cache.put(key, result)
+    return {**result, 'cached': False}
+
+def run_ocr_pipeline(file_obj: BinaryIO) -> Dict[str, Any]:
+    """Run OCR and structured extraction on a seekable image or PDF file object"""
+    header = file_obj.read(4)
+    file_obj.seek(0)
+    if not header:
+        raise ValueError('File data required')
+    
+    # Determine file type; PDF pages are rasterized lazily as OCR consumes them
+    if header == b'%PDF':
+        images = iter_pdf_images(file_obj)
+    else:
+        images = iter([Image.open(file_obj)])
+    
+    # OCR each page as soon as it is available so only a few pages are ever in memory
+    all_text = []
+    for img in images:
+        all_text.append(extract_text_with_ocr(img))
+        img.close()
+    
+    if not all_text:
+        raise ValueError('Failed to process file')
+    
+    # Extract structured data (cleans the text, keeping its lines)
+    extracted_data = extract_leave_letter_data('\n'.join(all_text))
+    
+    return {
+        'data': extracted_data,
+        'raw_text': extracted_data['raw_text'],
+        'page_count': len(all_text)
+    }
+
+def _process_file_in_worker(file_bytes: bytes) -> Dict[str, Any]:
+    """Pool task: per-file errors are returned rather than raised (the parent handles caching)"""
+    try:
+        return {'success': True, **run_ocr_pipeline(io.BytesIO(file_bytes))}
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
 @app.route('/api/process-leave-letter', methods=['POST'])
 def process_leave_letter():
-    """Process a single leave letter (image or PDF)"""
+    """Process a single leave letter (image or PDF)
+
+    Accepts a multipart "file" field, a raw binary body
+    (application/octet-stream, application/pdf or image/*), or the
+    original JSON body with a base64 "file".
+    """
     try:
-        data = request.json
-        if not data or 'file' not in data:
-            return jsonify({'error': 'File data required'}), 400
+        mimetype = request.mimetype
+        if mimetype == 'multipart/form-data':
+            upload = request.files.get('file')
+            if upload is None:
+                return jsonify({'error': 'File data required'}), 400
+            # Werkzeug already spooled the part to a temp file while parsing
+            file_obj = upload.stream
+        elif mimetype in ('application/octet-stream', 'application/pdf') or mimetype.startswith('image/'):
+            file_obj = spool_request_body()
+        else:
+            data = request.json
+            if not data or 'file' not in data:
+                return jsonify({'error': 'File data required'}), 400
+            try:
+                file_obj = io.BytesIO(decode_file_data(data['file']))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
         
-        # Decode base64 file
-        file_data = data['file']
-        if file_data.startswith('data:'):
-            file_data = file_data.split(',')[1]
-        file_bytes = base64.b64decode(file_data)
+        try:
+            with file_obj:
+                result = process_file(file_obj)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not result['cached']:
+            metrics.inc('attendance_ocr_pages_total', result['page_count'])
         
-        # Determine file type and convert to image(s)
-        images = []
-        if file_bytes.startswith(b'%PDF'):
-            # PDF file
-            images = pdf_to_images(file_bytes)
+        return jsonify({'success': True, **result})
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/process-leave-letters', methods=['POST'])
+def process_leave_letters():
+    """Process a batch of leave letters in parallel on the OCR worker pool
+
+    Accepts repeated multipart "files" fields, or JSON {"files": [...]}
+    where each entry is a base64 string or {"file": ..., "filename": ...}.
+    """
+    try:
+        # (filename, loader) pairs; loaders run per file so one bad entry doesn't fail the batch
+        entries = []
+        if request.mimetype == 'multipart/form-data':
+            for upload in request.files.getlist('files'):
+                entries.append((upload.filename, upload.read))
         else:
-            # Image file
-            image = Image.open(io.BytesIO(file_bytes))
-            images = [image]
-        
-        if not images:
-            return jsonify({'error': 'Failed to process file'}), 400
+            data = request.json
+            if not data or not isinstance(data.get('files'), list):
+                return jsonify({'error': 'files must be a non-empty array'}), 400
+            for entry in data['files']:
+                filename = entry.get('filename') if isinstance(entry, dict) else None
+                file_data = entry.get('file') if isinstance(entry, dict) else entry
+                entries.append((filename, lambda file_data=file_data: decode_file_data(file_data)))
         
-        # Extract text from first image (or combine all)
-        all_text = []
-        for img in images:
-            text = extract_text_with_ocr(img)
-            all_text.append(text)
+        if len(entries) == 0:
+            return jsonify({'error': 'files must be a non-empty array'}), 400
+        if len(entries) > MAX_BATCH_FILES:
+            return jsonify({'error': f'At most {MAX_BATCH_FILES} files per batch'}), 400
         
-        combined_text = '\n'.join(all_text)
-        cleaned_text = clean_text(combined_text)
+        results = []
+        futures = {}
+        keys = {}
+        settings = ocr_settings()
+        for index, (filename, load) in enumerate(entries):
+            results.append({'index': index, 'filename': filename})
+            try:
+                file_bytes = load()
+                if not file_bytes:
+                    raise ValueError('File data required')
+                key = OcrResultCache.key(hashlib.sha256(file_bytes).hexdigest(), settings)
+                cached = ocr_cache.get(key)
+                if cached is not None:
+                    results[index].update({'success': True, **cached, 'cached': True})
+                    continue
+                # Identical files within the batch share one OCR run
+                if key not in futures:
+                    futures[key] = get_ocr_pool().submit(_process_file_in_worker, file_bytes)
+                keys[index] = key
+            except Exception as e:
+                results[index].update({'success': False, 'error': str(e)})
         
-        # Extract structured data
-        extracted_data = extract_leave_letter_data(cleaned_text)
+        for index, key in keys.items():
+            try:
+                outcome = futures[key].result()
+            except BrokenProcessPool as e:
+                reset_ocr_pool()
+                outcome = {'success': False, 'error': f'OCR worker crashed: {e}'}
+            results[index].update(outcome)
+            if outcome['success']:
+                results[index]['cached'] = False
         
+        # OCR ran in the pool workers, so store and count their results here
+        for key, future in futures.items():
+            if future.done() and not future.exception() and future.result()['success']:
+                outcome = {k: v for k, v in future.result().items() if k != 'success'}
+                ocr_cache.put(key, outcome)
+                metrics.inc('attendance_ocr_pages_total', outcome['page_count'])
+        failed = sum(1 for r in results if not r['success'])
         return jsonify({
             'success': True,
-            'data': extracted_data,
-            'raw_text': cleaned_text
+            'results': results,
+            'processed': len(results) - failed,
+            'failed': failed
         })
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+ANALYSIS_STAGES = ['embedding', 'clustering', 'similarity', 'anomalies', 'categories']
+
+def _report_stage(progress: Optional[Callable[[str], None]], stage: str):
+    """Tell an optional progress listener which pipeline stage is starting"""
+    if progress is not None:
+        progress(stage)
+
+@timed_stage('categories')
+def build_grouped_categories(
+    leave_letters: List[Dict[str, Any]],
+    reasons: List[str],
+    clusters: np.ndarray,
+    index: SimilarityIndex,
+    similar_peers: Optional[int] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Group letters by cluster with in-category similarity scores"""
+    return {
+        category['category_id']: category
+        for category in iter_grouped_categories(leave_letters, reasons, clusters, index, similar_peers)
+    }
+
+def iter_grouped_categories(
+    leave_letters: List[Dict[str, Any]],
+    reasons: List[str],
+    clusters: np.ndarray,
+    index: SimilarityIndex,
+    similar_peers: Optional[int] = None
+) -> Iterator[Dict[str, Any]]:
+    """Yield each category with its students, in order of first appearance
+
+    Each student lists similarity to every peer in the category by default,
+    to the top similar_peers most similar ones, or to none when it is 0.
+    """
+    cluster_ids, first_seen = np.unique(clusters, return_index=True)
+    for cluster_id in cluster_ids[np.argsort(first_seen)]:
+        # Ascending, so students keep the letters' order
+        members = np.flatnonzero(clusters == cluster_id)
+        
+        if similar_peers == 0:
+            peer_scores = [{} for _ in members]
+        else:
+            peer_scores = index.peer_scores(members, similar_peers)
+        
+        cluster_id_str = str(int(cluster_id))
+        yield {
+            'category_id': cluster_id_str,
+            'representative_reason': reasons[members[0]],
+            'student_count': len(members),
+            'students': [
+                {
+                    'name': leave_letters[idx].get('student_name', 'Unknown'),
+                    'roll_number': leave_letters[idx].get('roll_number', 'N/A'),
+                    'date': leave_letters[idx].get('date', 'N/A'),
+                    'reason': reasons[idx],
+                    'similarity_scores': scores
+                }
+                for idx, scores in zip(members, peer_scores)
+            ],
+            'average_similarity': index.mean_similarity(members)
+        }
+
+def parse_leave_letters(data: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Validate an analysis request body, raising ValueError with a client-facing message"""
+    if not data or 'leave_letters' not in data:
+        raise ValueError('leave_letters array required')
+    
+    leave_letters = data['leave_letters']
+    if not isinstance(leave_letters, list) or len(leave_letters) == 0:
+        raise ValueError('leave_letters must be a non-empty array')
+    
+    if not any(letter.get('reason', '') for letter in leave_letters):
+        raise ValueError('No leave reasons found in letters')
+    
+    return leave_letters
+
+def read_backfill_records(path: str) -> List[Dict[str, Any]]:
+    """Records of a backfill letters.jsonl, latest per file, skipping a torn last line"""
+    records: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records.pop(record['path'], None)
+            records[record['path']] = record
+    return list(records.values())
+
+def backfill_letters(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Successfully extracted records, in the row order of the dataset's embeddings"""
+    return [record for record in records if record.get('success')]
+
+def load_backfill_dataset(name: str) -> Tuple[List[Dict[str, Any]], Optional[np.ndarray]]:
+    """Leave letters of a backfill dataset, with its embeddings when they are current"""
+    if not re.fullmatch(r'[\w.\-]+', name) or name.strip('.') == '':
+        raise ValueError('Invalid dataset name')
+    directory = os.path.join(BACKFILL_DIR, name)
+    if not os.path.isdir(directory):
+        raise ValueError(f'Dataset not found: {name}')
+    
+    letters = backfill_letters(read_backfill_records(os.path.join(directory, BACKFILL_LETTERS_FILE)))
+    embeddings = None
+    try:
+        with open(os.path.join(directory, BACKFILL_META_FILE)) as f:
+            meta = json.load(f)
+        # Stale when the model changed or letters were added after the embeddings were written
+        if meta.get('embedding_model') == EMBEDDING_MODEL_ID and meta.get('count') == len(letters):
+            embeddings = np.load(os.path.join(directory, BACKFILL_EMBEDDINGS_FILE), mmap_mode='r')
+    except (OSError, ValueError) as e:
+        print(f"Recomputing embeddings for dataset {name}: {e}")
+    return letters, embeddings
+
+def parse_analysis_options(data: Dict[str, Any]) -> Dict[str, Any]:
+    """run_analysis keyword arguments from an analysis request body"""
+    similar_peers = data.get('similar_peers')
+    if similar_peers is not None and (isinstance(similar_peers, bool) or not isinstance(similar_peers, int)
+                                      or similar_peers < 0):
+        raise ValueError('similar_peers must be a non-negative integer')
+    return {
+        'class_id': data.get('class_id'),
+        'similar_peers': similar_peers,
+        'use_history': bool(data.get('history', True))
+    }
+
+def _prepare_analysis(
+    leave_letters: List[Dict[str, Any]],
+    progress: Optional[Callable[[str], None]],
+    class_id: Optional[str],
+    embeddings: Optional[np.ndarray]
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Reasons, their embeddings and cluster labels: the part every analysis needs up front"""
+    metrics.inc('attendance_letters_analyzed_total', len(leave_letters))
+    
+    # Extract reasons
+    reasons = [letter.get('reason', '') for letter in leave_letters]
+    
+    # Compute embeddings
+    _report_stage(progress, 'embedding')
+    if embeddings is None:
+        embeddings = compute_embeddings(reasons)
+    else:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+    
+    # Cluster reasons
+    _report_stage(progress, 'clustering')
+    clusters = cluster_reasons(embeddings, class_id=class_id)
+    return reasons, embeddings, clusters
+
+def analysis_statistics(
+    total_letters: int,
+    total_categories: int,
+    total_anomalies: int,
+    risk_counts: Dict[str, int]
+) -> Dict[str, int]:
+    """The statistics block of an analysis response"""
+    return {
+        'total_letters': total_letters,
+        'total_categories': total_categories,
+        'total_anomalies': total_anomalies,
+        'high_risk_anomalies': risk_counts['high'],
+        'medium_risk_anomalies': risk_counts['medium'],
+        'low_risk_anomalies': risk_counts['low']
+    }
+
+def run_analysis(
+    leave_letters: List[Dict[str, Any]],
+    progress: Optional[Callable[[str], None]] = None,
+    class_id: Optional[str] = None,
+    similar_peers: Optional[int] = None,
+    embeddings: Optional[np.ndarray] = None,
+    use_history: bool = True
+) -> Dict[str, Any]:
+    """Cluster leave reasons, detect anomalies and build the analysis response
+
+    class_id, when given, lets clustering warm-start from that class's last run.
+    similar_peers limits each student's category similarity scores to the top k peers.
+    embeddings, when already known (e.g. from a backfill), skip the embedding model.
+    use_history compares the letters with, and then adds them to, the student history.
+    """
+    reasons, embeddings, clusters = _prepare_analysis(leave_letters, progress, class_id, embeddings)
+    
+    # Index normalized embeddings; similarities are computed in tiles as needed
+    _report_stage(progress, 'similarity')
+    with build_similarity_index(embeddings) as index:
+        # Detect anomalies
+        _report_stage(progress, 'anomalies')
+        history = history_entries(leave_letters, index) if use_history and student_history.enabled else None
+        anomalies = detect_anomalies(leave_letters, index, clusters, history)
+        
+        # Group by clusters
+        _report_stage(progress, 'categories')
+        grouped_categories = build_grouped_categories(leave_letters, reasons, clusters, index, similar_peers)
+    
+    if history is not None:
+        record_history(history)
+    
+    # Generate insights
+    risk_counts = count_risk_levels(anomalies)
+    insights = generate_insights(leave_letters, clusters, risk_counts)
+    
+    # Build response
+    response = {
+        'success': True,
+        'grouped_categories': list(grouped_categories.values()),
+        'anomalies': anomalies,
+        'insights': insights,
+        'statistics': analysis_statistics(len(leave_letters), len(grouped_categories), len(anomalies), risk_counts)
+    }
+    
+    return response
+
+def iter_analysis_records(
+    leave_letters: List[Dict[str, Any]],
+    class_id: Optional[str] = None,
+    similar_peers: Optional[int] = None,
+    embeddings: Optional[np.ndarray] = None,
+    use_history: bool = True
+) -> Iterator[Dict[str, Any]]:
+    """run_analysis as a sequence of records, each emitted as soon as it is known
+
+    {"type": "statistics"} (letter and category counts), then one
+    {"type": "anomaly"} per anomaly as detected, one {"type": "category"}
+    per category, {"type": "insights"}, and a final {"type": "summary"}
+    with the full statistics. Nothing but counts is kept between records.
+    """
+    reasons, embeddings, clusters = _prepare_analysis(leave_letters, None, class_id, embeddings)
+    total_categories = len(np.unique(clusters))
+    yield {'type': 'statistics', 'data': {'total_letters': len(leave_letters), 'total_categories': total_categories}}
+    
+    risk_counts = dict.fromkeys(RISK_LEVELS, 0)
+    total_anomalies = 0
+    with build_similarity_index(embeddings) as index:
+        history = history_entries(leave_letters, index) if use_history and student_history.enabled else None
+        for anomaly in iter_anomalies(leave_letters, index, clusters, history):
+            total_anomalies += 1
+            count_risk_levels([anomaly], risk_counts)
+            yield {'type': 'anomaly', 'data': anomaly}
+        
+        for category in iter_grouped_categories(leave_letters, reasons, clusters, index, similar_peers):
+            yield {'type': 'category', 'data': category}
+    
+    if history is not None:
+        record_history(history)
+    
+    yield {'type': 'insights', 'data': generate_insights(leave_letters, clusters, risk_counts)}
+    yield {
+        'type': 'summary',
+        'data': analysis_statistics(len(leave_letters), total_categories, total_anomalies, risk_counts)
+    }
+
+def get_analysis_executor() -> ThreadPoolExecutor:
+    """Lazily start the background analysis executor (threads don't survive a fork)"""
+    global analysis_executor
+    with analysis_executor_lock:
+        if analysis_executor is None:
+            analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='analysis')
+    return analysis_executor
+
+def _run_analysis_job(job_id: str, leave_letters: List[Dict[str, Any]], options: Dict[str, Any]):
+    """Executor task: run the pipeline and record stage progress in the job store"""
+    stages_completed: List[str] = []
+    current_stage = None
+    
+    def progress(stage: str):
+        nonlocal current_stage
+        if current_stage is not None:
+            stages_completed.append(current_stage)
+        current_stage = stage
+        analysis_jobs.update(
+            job_id,
+            stage=stage,
+            stages_completed=stages_completed,
+            progress=round(ANALYSIS_STAGES.index(stage) / len(ANALYSIS_STAGES), 2)
+        )
+    
+    analysis_jobs.update(job_id, status='running', started_at=datetime.utcnow().isoformat())
+    try:
+        with collect_timings() as timings:
+            result = run_analysis(leave_letters, progress=progress, **options)
+        if current_stage is not None:
+            stages_completed.append(current_stage)
+        analysis_jobs.update(
+            job_id,
+            status='completed',
+            stage=None,
+            stages_completed=stages_completed,
+            progress=1.0,
+            result=result,
+            timings={stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+            finished_at=datetime.utcnow().isoformat()
+        )
+    except Exception as e:
+        analysis_jobs.update(job_id, status='failed', error=str(e), finished_at=datetime.utcnow().isoformat())
+
+def submit_analysis_job(
+    leave_letters: List[Dict[str, Any]],
+    options: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Queue an analysis (options are run_analysis keyword arguments), reusing an existing job for identical input"""
+    options = options or {}
+    # Precomputed embeddings follow from the letters, so they are left out of the hash
+    hashed_options = {key: value for key, value in options.items() if key != 'embeddings'}
+    input_hash = hashlib.sha256(
+        json.dumps([leave_letters, hashed_options], sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+    
+    job, is_new = analysis_jobs.submit(input_hash, {
+        'job_id': uuid.uuid4().hex,
+        'status': 'queued',
+        'stage': None,
+        'stages_completed': [],
+        'progress': 0.0,
+        'letter_count': len(leave_letters),
+        'created_at': datetime.utcnow().isoformat(),
+        'started_at': None,
+        'finished_at': None,
+        'error': None,
+        'timings': None
+    })
+    if is_new:
+        get_analysis_executor().submit(_run_analysis_job, job['job_id'], leave_letters, options)
+    return job
+
 @app.route('/api/analyze-leave-letters', methods=['POST'])
 def analyze_leave_letters():
-    """Analyze multiple leave letters for clustering and anomaly detection"""
+    """Analyze multiple leave letters for clustering and anomaly detection
+
+    With "async": true (or ?async=true) the analysis is queued and a job id
+    is returned immediately; poll /api/analyze-leave-letters/jobs/<job_id>.
+    An optional "class_id" reuses that class's previous clustering as a warm start,
+    and "similar_peers": k keeps only each student's k most similar category peers
+    (0 for none) so large batches don't return n² similarity scores.
+    Letters are also checked against, and added to, the per-student history
+    (see /api/students/<key>/history) unless "history" is false.
+    Instead of "leave_letters", "dataset" names a backfill.py output under
+    BACKFILL_DIR, whose stored embeddings are reused.
+    With "stream": true (or ?stream=true, or Accept: application/x-ndjson) the
+    result is streamed as newline-delimited JSON records; see iter_analysis_records.
+    """
     try:
-        data = request.json
-        if not data or 'leave_letters' not in data:
-            return jsonify({'error': 'leave_letters array required'}), 400
+        data = request.json or {}
+        try:
+            options = parse_analysis_options(data)
+            if data.get('dataset'):
+                # The rest of the body (async, stream, ...) still applies to the dataset's letters
+                dataset_letters, options['embeddings'] = load_backfill_dataset(str(data['dataset']))
+                leave_letters = parse_leave_letters({'leave_letters': dataset_letters})
+            else:
+                leave_letters = parse_leave_letters(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        leave_letters = data['leave_letters']
-        if not isinstance(leave_letters, list) or len(leave_letters) == 0:
-            return jsonify({'error': 'leave_letters must be a non-empty array'}), 400
+        stream = (
+            bool(data.get('stream')) or request.args.get('stream') == 'true'
+            or request.accept_mimetypes.best == 'application/x-ndjson'
+        )
+        if data.get('async') or request.args.get('async') == 'true':
+            if stream:
+                return jsonify({'error': 'stream and async cannot be combined'}), 400
+            job = submit_analysis_job(leave_letters, options)
+            return jsonify({
+                'success': True,
+                'status_url': f"/api/analyze-leave-letters/jobs/{job['job_id']}",
+                **job
+            }), 202
         
-        # Extract reasons
-        reasons = [letter.get('reason', '') for letter in leave_letters]
-        if not any(reasons):
-            return jsonify({'error': 'No leave reasons found in letters'}), 400
+        if stream:
+            return Response(stream_with_context(stream_analysis(leave_letters, options)),
+                            mimetype='application/x-ndjson')
         
-        # Compute embeddings
-        embeddings = compute_embeddings(reasons)
+        return jsonify(run_analysis(leave_letters, **options))
+    
+    except Exception as e:
+        import traceback
+        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+
+def stream_analysis(leave_letters: List[Dict[str, Any]], options: Dict[str, Any]) -> Iterator[str]:
+    """NDJSON lines of an analysis; a failure part-way ends the stream with an error record"""
+    try:
+        for record in iter_analysis_records(leave_letters, **options):
+            yield app.json.dumps(record) + '\n'
+    except Exception as e:
+        print(f"Streamed analysis failed: {e}")
+        yield app.json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+
+@app.route('/api/analyze-leave-letters/jobs/<job_id>', methods=['GET'])
+def analysis_job_status(job_id: str):
+    """Stage-level progress of a queued analysis, with the result once completed"""
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, **job})
+
+class AnalysisSession:
+    """Append-only analysis state for one class.
+
+    New letters are compared only against what the session already
+    holds, assigned to categories by online (mini-batch k-means style)
+    centroid updates, and only the anomalies they cause are reported.
+    Sessions live in process memory, so each server worker has its own.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.letters: List[Dict[str, Any]] = []
+        # Normalized embeddings of every letter so far, stored like a one-off analysis's
+        self.index: Optional[SimilarityIndex] = None
+        self.clusters = np.zeros(0, dtype=int)
+        self.centroids: Optional[np.ndarray] = None
+        self.cluster_sizes = np.zeros(0, dtype=int)
+        self.student_letters: Dict[Any, List[int]] = {}
+        self.date_groups: Dict[Tuple[Any, int], List[int]] = {}
+        self.anomaly_count = 0
+        self.lock = threading.Lock()
+        self.created_at = datetime.utcnow().isoformat()
+        self.updated_at = self.created_at
+
+    def _assign_categories(self, new_embeddings: np.ndarray) -> np.ndarray:
+        """Assign new letters to categories, updating centroids online"""
+        if self.centroids is None:
+            # First upload: seed categories with a regular clustering run
+            labels = cluster_reasons(new_embeddings)
+            _, labels = np.unique(labels, return_inverse=True)
+            self.centroids = np.array([
+                new_embeddings[labels == label].mean(axis=0) for label in range(labels.max() + 1)
+            ])
+            self.cluster_sizes = np.bincount(labels)
+            return labels
         
-        # Cluster reasons
-        clusters = cluster_reasons(embeddings)
+        labels = np.empty(len(new_embeddings), dtype=int)
+        for idx, vector in enumerate(new_embeddings):
+            similarities = normalize(self.centroids) @ vector
+            label = int(np.argmax(similarities))
+            if similarities[label] < SESSION_NEW_CATEGORY_SIMILARITY and len(self.centroids) < SESSION_MAX_CATEGORIES:
+                self.centroids = np.vstack([self.centroids, vector])
+                self.cluster_sizes = np.append(self.cluster_sizes, 1)
+                label = len(self.centroids) - 1
+            else:
+                # Per-centroid learning rate 1/count keeps each centroid the mean of its members
+                self.cluster_sizes[label] += 1
+                self.centroids[label] += (vector - self.centroids[label]) / self.cluster_sizes[label]
+            labels[idx] = label
+        return labels
+
+    def add_letters(self, new_letters: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Append letters and return only the anomalies they introduce"""
+        start = len(self.letters)
+        new_embeddings = normalize(compute_embeddings([letter.get('reason', '') for letter in new_letters]))
+        labels = self._assign_categories(new_embeddings)
         
-        # Compute similarity matrix
-        similarity_matrix = compute_similarity_matrix(embeddings)
+        self.letters.extend(new_letters)
+        if self.index is None:
+            self.index = build_similarity_index(new_embeddings)
+        else:
+            self.index.append(new_embeddings, mmap=len(self.letters) >= SIMILARITY_MMAP_MIN_LETTERS)
+        self.clusters = np.concatenate([self.clusters, labels])
         
-        # Detect anomalies
-        anomalies = detect_anomalies(leave_letters, embeddings, similarity_matrix, clusters)
+        anomalies = []
         
-        # Group by clusters
-        grouped_categories = {}
-        for idx, cluster_id in enumerate(clusters):
-            cluster_id_str = str(int(cluster_id))
-            if cluster_id_str not in grouped_categories:
-                grouped_categories[cluster_id_str] = {
-                    'category_id': cluster_id_str,
-                    'representative_reason': reasons[idx],
-                    'student_count': 0,
-                    'students': [],
-                    'average_similarity': 0.0
-                }
-            
-            student_info = {
-                'name': leave_letters[idx].get('student_name', 'Unknown'),
-                'roll_number': leave_letters[idx].get('roll_number', 'N/A'),
-                'date': leave_letters[idx].get('date', 'N/A'),
-                'reason': reasons[idx],
-                'similarity_scores': {}
-            }
-            
-            # Add similarity scores with other students in same cluster
-            for other_idx, other_cluster_id in enumerate(clusters):
-                if other_cluster_id == cluster_id and idx != other_idx:
-                    similarity = float(similarity_matrix[idx][other_idx])
-                    student_info['similarity_scores'][other_idx] = similarity
-            
-            grouped_categories[cluster_id_str]['students'].append(student_info)
-            grouped_categories[cluster_id_str]['student_count'] += 1
+        # 1. New letters highly similar to any earlier or other new letter
+        summaries = {}
+        for i, j, similarity in self.index.pairs_above(HIGH_SIMILARITY_THRESHOLD, start):
+            for idx in (i, j):
+                if idx not in summaries:
+                    summaries[idx] = _student_summary(self.letters[idx])
+            anomalies.append(_high_similarity_anomaly(summaries[i], summaries[j], similarity))
+        
+        # 2. Students whose new letters make a repeated-excuse pattern
+        touched_students = []
+        for idx in range(start, len(self.letters)):
+            student_id = _student_key(self.letters[idx])
+            if student_id not in self.student_letters:
+                self.student_letters[student_id] = []
+            self.student_letters[student_id].append(idx)
+            if student_id not in touched_students:
+                touched_students.append(student_id)
+        
+        for student_id in touched_students:
+            anomaly = _repeated_excuse_anomaly(
+                self.letters, student_id, self.student_letters[student_id], self.index.similarity
+            )
+            if anomaly:
+                anomalies.append(anomaly)
+        
+        # 3. Same-date groups that grew past the threshold
+        touched_groups = []
+        for idx in range(start, len(self.letters)):
+            key = (self.letters[idx].get('date', 'unknown'), int(self.clusters[idx]))
+            self.date_groups.setdefault(key, []).append(idx)
+            if key not in touched_groups:
+                touched_groups.append(key)
+        
+        for key in touched_groups:
+            indices = self.date_groups[key]
+            if len(indices) >= LARGE_GROUP_MIN_SIZE:
+                avg_similarity = self.index.mean_similarity(indices)
+                anomalies.append(_large_group_anomaly(self.letters, key[0], indices, avg_similarity))
         
-        # Calculate average similarity for each category
-        for category in grouped_categories.values():
-            similarities = []
-            student_indices = [i for i, c in enumerate(clusters) if int(c) == int(category['category_id'])]
-            for i in student_indices:
-                for j in student_indices:
-                    if i < j:
-                        similarities.append(similarity_matrix[i][j])
-            category['average_similarity'] = float(np.mean(similarities)) if similarities else 1.0
+        # 4. Vague reasons among the new letters
+        for letter in new_letters:
+            anomaly = _vague_reason_anomaly(letter)
+            if anomaly:
+                anomalies.append(anomaly)
         
-        # Generate insights
-        insights = generate_insights(leave_letters, clusters, anomalies)
+        self.anomaly_count += len(anomalies)
+        self.updated_at = datetime.utcnow().isoformat()
         
-        # Build response
-        response = {
+        return {
             'success': True,
-            'grouped_categories': list(grouped_categories.values()),
-            'anomalies': anomalies,
-            'insights': insights,
+            'session_id': self.session_id,
+            'new_letters': len(new_letters),
+            'total_letters': len(self.letters),
+            'assignments': [
+                {'index': start + offset, 'category_id': str(int(label))}
+                for offset, label in enumerate(labels)
+            ],
+            'new_anomalies': anomalies,
             'statistics': {
-                'total_letters': len(leave_letters),
-                'total_categories': len(grouped_categories),
-                'total_anomalies': len(anomalies),
-                'high_risk_anomalies': sum(1 for a in anomalies if a.get('risk_level') == 'high'),
-                'medium_risk_anomalies': sum(1 for a in anomalies if a.get('risk_level') == 'medium'),
-                'low_risk_anomalies': sum(1 for a in anomalies if a.get('risk_level') == 'low')
+                'total_categories': len(self.centroids),
+                'new_anomalies': len(anomalies),
+                **{f'{level}_risk_anomalies': count for level, count in count_risk_levels(anomalies).items()}
             }
         }
+
+    def summary(self) -> Dict[str, Any]:
+        """Current size and categories of the session"""
+        return {
+            'session_id': self.session_id,
+            'total_letters': len(self.letters),
+            'total_anomalies': self.anomaly_count,
+            'categories': [
+                {'category_id': str(label), 'student_count': int(count)}
+                for label, count in enumerate(self.cluster_sizes)
+            ],
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+def get_analysis_session(session_id: str, create: bool = False) -> Optional[AnalysisSession]:
+    """Look up a session, optionally creating it and evicting the least recently used"""
+    with analysis_sessions_lock:
+        session = analysis_sessions.get(session_id)
+        if session is None and create:
+            session = AnalysisSession(session_id)
+            analysis_sessions[session_id] = session
+            while len(analysis_sessions) > ANALYSIS_SESSION_LIMIT:
+                analysis_sessions.popitem(last=False)
+        if session is not None:
+            analysis_sessions.move_to_end(session_id)
+        return session
+
+@app.route('/api/analysis-sessions/<session_id>/letters', methods=['POST'])
+def add_session_letters(session_id: str):
+    """Append leave letters to a class session and return only the new anomalies"""
+    try:
+        try:
+            leave_letters = parse_leave_letters(request.json)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify(response)
+        session = get_analysis_session(session_id, create=True)
+        with session.lock:
+            return jsonify(session.add_letters(leave_letters))
     
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
 
+@app.route('/api/analysis-sessions/<session_id>', methods=['GET'])
+def analysis_session_summary(session_id: str):
+    """Size and categories of a class session"""
+    session = get_analysis_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    with session.lock:
+        return jsonify({'success': True, **session.summary()})
+
+@app.route('/api/analysis-sessions/<session_id>', methods=['DELETE'])
+def delete_analysis_session(session_id: str):
+    """Forget a class session"""
+    with analysis_sessions_lock:
+        if analysis_sessions.pop(session_id, None) is None:
+            return jsonify({'error': 'Session not found'}), 404
+    return jsonify({'success': True})
+
+@app.route('/api/students/<path:key>/history', methods=['GET'])
+def student_letter_history(key: str):
+    """A student's stored letters (by roll number or name), optionally only the last ?days=N days"""
+    if not student_history.enabled:
+        return jsonify({'error': 'Student history is disabled'}), 404
+    since_day = None
+    if request.args.get('days'):
+        try:
+            days = int(request.args['days'])
+        except ValueError:
+            return jsonify({'error': 'days must be an integer'}), 400
+        since_day = datetime.now().date().toordinal() - days
+    normalized = student_key(key)
+    letters = student_history.history(normalized, since_day) if normalized else []
+    for letter in letters:
+        letter.pop('day')
+    return jsonify({'success': True, 'student_key': normalized, 'count': len(letters), 'letters': letters})
+
 if __name__ == '__main__':
+    start_model_preload()
     port = int(os.environ.get('PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=False)
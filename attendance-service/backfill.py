@@ -0,0 +1,181 @@
+"""
+Bulk backfill of scanned leave letters
+Walks a directory of images/PDFs, runs OCR and extraction on the OCR worker pool, then embeds the reasons.
+Progress is appended to letters.jsonl as files finish, so an interrupted run resumes where it stopped.
+
+Output (a dataset the analyze endpoint loads with {"dataset": "<name>"}):
+    BACKFILL_DIR/<name>/letters.jsonl   one record per file
+    BACKFILL_DIR/<name>/embeddings.npy  float32 reason embeddings of the successful records
+    BACKFILL_DIR/<name>/meta.json       embedding model and row count
+    BACKFILL_DIR/<name>/letters.parquet with --parquet (needs pyarrow)
+
+Usage:
+    python backfill.py /data/scans/2023 --name 2023
+    python backfill.py /data/scans/2023 --name 2023 --retry-failed
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+os.environ.setdefault('PRELOAD_MODELS', 'none')
+
+import numpy as np
+import pandas as pd
+
+import app
+from caching import OcrResultCache
+
+FILE_EXTENSIONS = {'.pdf', '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp'}
+
+def iter_source_files(source_dir: str) -> Iterator[str]:
+    """Images and PDFs under source_dir, as sorted relative paths"""
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() in FILE_EXTENSIONS:
+                yield os.path.relpath(os.path.join(root, filename), source_dir)
+
+def letter_record(path: str, digest: str, outcome: Dict[str, Any]) -> Dict[str, Any]:
+    """One letters.jsonl line: the extracted fields at the top level, like an analysis request's letters"""
+    record = {'path': path, 'sha256': digest, 'success': outcome['success']}
+    if outcome['success']:
+        data = outcome['data']
+        record.update({
+            'student_name': data['student_name'],
+            'roll_number': data['roll_number'],
+            'date': data['date'],
+            'reason': data['reason'],
+            'confidence': data['confidence'],
+            'page_count': outcome['page_count'],
+            'raw_text': outcome['raw_text']
+        })
+    else:
+        record['error'] = outcome['error']
+    return record
+
+def run_ocr(source_dir: str, paths: List[str], letters_path: str, in_flight: int) -> Tuple[int, int]:
+    """OCR every path on the worker pool, appending a record per file as it finishes (in order)"""
+    settings = app.ocr_settings()
+    pending: deque = deque()
+    succeeded = failed = 0
+    started = time.perf_counter()
+
+    with open(letters_path, 'a', encoding='utf-8') as out:
+        def finish(path: str, digest: str, key: Optional[str], result):
+            nonlocal succeeded, failed
+            try:
+                outcome = result.result() if isinstance(result, Future) else result
+            except BrokenProcessPool as e:
+                app.reset_ocr_pool()
+                outcome = {'success': False, 'error': f'OCR worker crashed: {e}'}
+            if outcome['success'] and key is not None and not outcome.get('cached'):
+                app.ocr_cache.put(key, {field: outcome[field] for field in ('data', 'raw_text', 'page_count')})
+            # One flushed line per file is the checkpoint
+            out.write(json.dumps(letter_record(path, digest, outcome)) + '\n')
+            out.flush()
+            if outcome['success']:
+                succeeded += 1
+            else:
+                failed += 1
+            done = succeeded + failed
+            if done % 50 == 0 or done == len(paths):
+                rate = done / max(time.perf_counter() - started, 1e-9)
+                print(f"{done}/{len(paths)} files ({failed} failed, {rate:.1f} files/s)")
+
+        for path in paths:
+            try:
+                with open(os.path.join(source_dir, path), 'rb') as f:
+                    file_bytes = f.read()
+                digest = hashlib.sha256(file_bytes).hexdigest()
+                key = OcrResultCache.key(digest, settings)
+                cached = app.ocr_cache.get(key)
+                if cached is not None:
+                    result = {'success': True, **cached, 'cached': True}
+                elif not file_bytes:
+                    result = {'success': False, 'error': 'File data required'}
+                else:
+                    result = app.get_ocr_pool().submit(app._process_file_in_worker, file_bytes)
+            except OSError as e:
+                digest, key, result = None, None, {'success': False, 'error': str(e)}
+            pending.append((path, digest, key, result))
+            # Bound the files held in memory while the pool works
+            while len(pending) >= in_flight:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    return succeeded, failed
+
+def write_embeddings(output_dir: str, letters: List[Dict[str, Any]]):
+    """Embed every successful record's reason; the embedding cache makes re-runs cheap"""
+    print(f"Embedding {len(letters)} reasons...")
+    embeddings = app.compute_embeddings([letter.get('reason') or '' for letter in letters])
+    embeddings_path = os.path.join(output_dir, app.BACKFILL_EMBEDDINGS_FILE)
+    # Write-then-rename so a reader never sees a partial file
+    with open(embeddings_path + '.tmp', 'wb') as f:
+        np.save(f, embeddings.astype(np.float32))
+    os.replace(embeddings_path + '.tmp', embeddings_path)
+
+    meta = {
+        'embedding_model': app.EMBEDDING_MODEL_ID,
+        'count': len(letters),
+        'dimensions': int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        'extractor_version': app.EXTRACTOR_VERSION,
+        'ocr_settings': app.ocr_settings()
+    }
+    with open(os.path.join(output_dir, app.BACKFILL_META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+def write_parquet(output_dir: str, records: List[Dict[str, Any]]):
+    """Columnar copy of the records, one confidence column per field"""
+    frame = pd.json_normalize(records, sep='_')
+    try:
+        frame.to_parquet(os.path.join(output_dir, 'letters.parquet'), index=False)
+    except ImportError:
+        print("Skipping letters.parquet: install pyarrow to write Parquet")
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='OCR, extract and embed a directory of scanned leave letters')
+    parser.add_argument('source', help='Directory of images and PDFs (searched recursively)')
+    parser.add_argument('--name', help='Dataset name under BACKFILL_DIR (default: the source directory name)')
+    parser.add_argument('--output', help='Write the dataset here instead of BACKFILL_DIR/<name>')
+    parser.add_argument('--retry-failed', action='store_true', help='Re-run files that failed in an earlier run')
+    parser.add_argument('--in-flight', type=int, default=max(2, app.OCR_WORKERS * 2),
+                        help='Files read ahead of the OCR workers')
+    parser.add_argument('--parquet', action='store_true', help='Also write letters.parquet')
+    args = parser.parse_args(argv)
+
+    source_dir = os.path.abspath(args.source)
+    if not os.path.isdir(source_dir):
+        parser.error(f'not a directory: {args.source}')
+    name = args.name or os.path.basename(source_dir.rstrip(os.sep))
+    output_dir = args.output or os.path.join(app.BACKFILL_DIR, name)
+    os.makedirs(output_dir, exist_ok=True)
+    letters_path = os.path.join(output_dir, app.BACKFILL_LETTERS_FILE)
+
+    # Resume: skip files already recorded (failed ones too, unless retrying)
+    done = {
+        record['path'] for record in app.read_backfill_records(letters_path)
+        if record['success'] or not args.retry_failed
+    }
+    paths = [path for path in iter_source_files(source_dir) if path not in done]
+    print(f"{len(done)} files already processed, {len(paths)} to go")
+
+    if paths:
+        succeeded, failed = run_ocr(source_dir, paths, letters_path, args.in_flight)
+        print(f"OCR finished: {succeeded} succeeded, {failed} failed")
+
+    records = app.read_backfill_records(letters_path)
+    write_embeddings(output_dir, app.backfill_letters(records))
+    if args.parquet:
+        write_parquet(output_dir, records)
+    print(f"Dataset written to {output_dir}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Benchmark harness for the attendance analysis pipeline
+Generates synthetic leave letters and times every stage, writing JSON that can be diffed between releases
+
+Usage:
+    python benchmark.py --sizes 10,100,1000 --output bench.json
+    python benchmark.py --sizes 10000 --skip-ocr
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import difflib
+import argparse
+import platform
+import tracemalloc
+import contextlib
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Callable, Optional
+
+# Measure the model, not the embedding cache, unless asked otherwise
+os.environ.setdefault('EMBEDDING_CACHE_PATH', '')
+# Synthetic letters must not end up in the student history
+os.environ.setdefault('STUDENT_HISTORY_PATH', '')
+os.environ.setdefault('PRELOAD_MODELS', 'none')
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import app
+import preprocessing
+import embedding_backends
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+NAMES = ['Aarav', 'Diya', 'Ishaan', 'Ananya', 'Vihaan', 'Saanvi', 'Arjun', 'Meera', 'Kabir', 'Riya',
+         'Rohan', 'Priya', 'Aditya', 'Kavya', 'Nikhil', 'Sneha', 'Rahul', 'Pooja', 'Karan', 'Nisha']
+SURNAMES = ['Sharma', 'Patel', 'Reddy', 'Nair', 'Iyer', 'Gupta', 'Singh', 'Das', 'Menon', 'Joshi']
+CAUSES = [
+    'I was suffering from high fever and the doctor advised complete bed rest',
+    'I had to attend my elder sister\'s wedding in our native village',
+    'my grandmother was admitted to the hospital and I had to accompany her',
+    'I met with a minor accident and injured my leg while coming to college',
+    'I had to appear for a competitive examination held on the same day',
+    'due to personal reasons',
+    'due to unavoidable circumstances',
+    'there was a death in the family and we had to travel for the funeral',
+    'I had a severe stomach infection and was unable to travel',
+    'our family had an important religious function at home',
+]
+TEMPLATES = [
+    'Respected Sir, I kindly request leave for {days} days as {cause}. Kindly grant me leave.',
+    'I was unable to attend classes on {date} because {cause}. Please excuse my absence.',
+    'With due respect, I request you to grant me leave from {date} since {cause}.',
+]
+
+def synthetic_letters(count: int, seed: int = 42) -> List[Dict[str, Any]]:
+    """Leave letters as the analysis endpoint receives them, with realistic repeats"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    students = [(f'{rng.choice(NAMES)} {rng.choice(SURNAMES)}', f'CS{21000 + i}') for i in range(max(1, count // 3))]
+    letters = []
+    for _ in range(count):
+        name, roll = rng.choice(students)
+        date = (start + timedelta(days=rng.randrange(120))).strftime('%d/%m/%Y')
+        reason = rng.choice(TEMPLATES).format(days=rng.randint(1, 4), date=date, cause=rng.choice(CAUSES))
+        letters.append({'student_name': name, 'roll_number': roll, 'date': date, 'reason': reason})
+    return letters
+
+def letter_text(letter: Dict[str, Any]) -> str:
+    """Full letter text around a synthetic reason, as OCR would read it"""
+    return '\n'.join([
+        'To The Principal',
+        'ABC College of Engineering',
+        f"Date: {letter['date']}",
+        'Subject: Leave application',
+        'Respected Sir,',
+        letter['reason'],
+        'Thanking you.',
+        'Yours sincerely',
+        f"Name: {letter['student_name']}",
+        f"Roll No: {letter['roll_number']}",
+    ])
+
+def render_letter(letter: Dict[str, Any], width: int = 1240, height: int = 1754) -> Image.Image:
+    """Render a letter onto an A4-sized page (150 dpi)"""
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    y = 120
+    for line in letter_text(letter).split('\n'):
+        # Wrap long lines roughly at page width
+        words, current = line.split(), ''
+        for word in words:
+            if len(current) + len(word) > 90:
+                draw.text((100, y), current, fill='black')
+                y += 40
+                current = ''
+            current = f'{current} {word}'.strip()
+        draw.text((100, y), current, fill='black')
+        y += 60
+    return image
+
+def render_pdf(letters: List[Dict[str, Any]]) -> bytes:
+    """One PDF with a page per letter"""
+    pages = [render_letter(letter) for letter in letters]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:], resolution=150)
+    return buffer.getvalue()
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process so far"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def summarize(latencies: List[float], items: int, peak_bytes: Optional[int]) -> Dict[str, Any]:
+    """Latency percentiles and throughput for one stage"""
+    values = np.array(latencies)
+    summary = {
+        'calls': len(latencies),
+        'items_per_call': items,
+        'mean_ms': round(float(values.mean()) * 1000, 3),
+        'p50_ms': round(float(np.percentile(values, 50)) * 1000, 3),
+        'p90_ms': round(float(np.percentile(values, 90)) * 1000, 3),
+        'p99_ms': round(float(np.percentile(values, 99)) * 1000, 3),
+        'throughput_per_s': round(items / float(values.mean()), 2) if values.mean() > 0 else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
+    if peak_bytes is not None:
+        summary['peak_traced_mb'] = round(peak_bytes / (1024 * 1024), 2)
+    return summary
+
+class Bench:
+    """Runs stages, collecting latencies and (optionally) traced peak memory"""
+
+    def __init__(self, repeats: int, trace_memory: bool):
+        self.repeats = repeats
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+
+    def run(self, fn: Callable[[], Any], items: int, repeats: Optional[int] = None) -> Dict[str, Any]:
+        latencies = []
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        for _ in range(repeats or self.repeats):
+            started = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - started)
+        peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        return summarize(latencies, items, peak)
+
+    def run_each(self, fn: Callable[[Any], Any], inputs: List[Any]) -> Dict[str, Any]:
+        """Time fn once per input, for stages whose latency is per item"""
+        latencies = []
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        for value in inputs:
+            started = time.perf_counter()
+            fn(value)
+            latencies.append(time.perf_counter() - started)
+        peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        return summarize(latencies, 1, peak)
+
+def text_accuracy(expected: str, actual: str) -> float:
+    """Character-level similarity of OCR output to the rendered text (1.0 is exact)"""
+    return difflib.SequenceMatcher(None, ' '.join(expected.split()), ' '.join(actual.split())).ratio()
+
+def bench_ocr(bench: Bench, samples: int, pdf_pages: int, qualities: List[str], photo_scale: float) -> Dict[str, Any]:
+    """OCR-side stages on a fixed number of rendered letters"""
+    letters = synthetic_letters(samples, seed=7)
+    images = [render_letter(letter) for letter in letters]
+    pdf_bytes = render_pdf(letters[:pdf_pages])
+    app.get_ocr_engine()
+
+    results = {}
+    results['pdf_to_images'] = bench.run(lambda: app.pdf_to_images(pdf_bytes), items=pdf_pages)
+    results['extract_text_with_ocr'] = bench.run_each(app.extract_text_with_ocr, images)
+
+    # Speed/accuracy of each preprocessing preset on phone-photo sized pages
+    photos = [image.resize((round(image.width * photo_scale), round(image.height * photo_scale)), Image.LANCZOS)
+              for image in images]
+    results['ocr_quality'] = {}
+    for quality in qualities:
+        entry = bench.run_each(lambda image: app.extract_text_with_ocr(image, quality=quality), photos)
+        entry['preprocess'] = bench.run_each(lambda image: preprocessing.preprocess_for_ocr(image, quality), photos)
+        entry['accuracy'] = round(float(np.mean([
+            text_accuracy(letter_text(letter), app.extract_text_with_ocr(photo, quality=quality))
+            for letter, photo in zip(letters, photos)
+        ])), 4)
+        results['ocr_quality'][quality] = entry
+    return results
+
+def bench_analysis(bench: Bench, size: int, max_matrix: int) -> Dict[str, Any]:
+    """Text and analysis stages on `size` synthetic letters"""
+    letters = synthetic_letters(size)
+    texts = [letter_text(letter) for letter in letters]
+    reasons = [letter['reason'] for letter in letters]
+    app.get_embedding_model()
+
+    def embed():
+        app.embedding_cache.clear_memory()
+        return app.compute_embeddings(reasons)
+
+    results = {}
+    results['extract_leave_letter_data'] = bench.run(
+        lambda: app.extract_leave_letters_data(texts), items=size
+    )
+    results['compute_embeddings'] = bench.run(embed, items=size)
+    embeddings = app.compute_embeddings(reasons)
+    results['cluster_reasons'] = bench.run(lambda: app.cluster_reasons(embeddings), items=size)
+    clusters = app.cluster_reasons(embeddings)
+
+    if size <= max_matrix:
+        results['compute_similarity_matrix'] = bench.run(lambda: app.compute_similarity_matrix(embeddings), items=size)
+
+    results['build_similarity_index'] = bench.run(lambda: app.build_similarity_index(embeddings).close(), items=size)
+    with app.build_similarity_index(embeddings) as index:
+        results['detect_anomalies'] = bench.run(lambda: app.detect_anomalies(letters, index, clusters), items=size)
+
+    # End-to-end analysis, split by the stages run_analysis reports
+    stage_latencies: Dict[str, List[float]] = {}
+    response_sizes = []
+
+    def analyze():
+        marks = []
+        app.embedding_cache.clear_memory()
+        started = time.perf_counter()
+        response = app.run_analysis(letters, progress=lambda stage: marks.append((stage, time.perf_counter())))
+        marks.append(('done', time.perf_counter()))
+        for (stage, at), (_, until) in zip(marks, marks[1:]):
+            stage_latencies.setdefault(stage, []).append(until - at)
+        serialized = json.dumps(response)
+        stage_latencies.setdefault('serialization', []).append(time.perf_counter() - marks[-1][1])
+        stage_latencies.setdefault('total', []).append(time.perf_counter() - started)
+        response_sizes.append(len(serialized))
+
+    results['analyze_leave_letters'] = bench.run(analyze, items=size)
+    results['analyze_leave_letters']['stages'] = {
+        stage: summarize(latencies, size, None) for stage, latencies in stage_latencies.items()
+    }
+    results['analyze_leave_letters']['response_bytes'] = response_sizes[-1]
+    return results
+
+def bench_embedding_backends(bench: Bench, backends: List[str], count: int, batch_size: int) -> Dict[str, Any]:
+    """Encode latency of each embedding backend, and its parity with the float32 model"""
+    reasons = [letter['reason'] for letter in synthetic_letters(count, seed=11)]
+    reference = embedding_backends.load_backend('torch', app.EMBEDDING_MODEL_NAME, app.CACHE_DIR)
+    results = {}
+    for name in backends:
+        print(f'Benchmarking {name} embeddings...')
+        started = time.perf_counter()
+        model = reference if name == 'torch' else embedding_backends.load_backend(name, app.EMBEDDING_MODEL_NAME, app.CACHE_DIR)
+        load_seconds = time.perf_counter() - started
+        entry = bench.run(lambda: model.encode(reasons, batch_size=batch_size), items=count)
+        entry['load_seconds'] = round(load_seconds, 3)
+        entry['parity'] = embedding_backends.parity_check(model, reference, reasons[:200])
+        results[name] = entry
+    return results
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmark the attendance analysis pipeline')
+    parser.add_argument('--sizes', default='10,100,1000', help='Comma-separated letter counts (10 to 10000)')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per stage')
+    parser.add_argument('--ocr-samples', type=int, default=5, help='Rendered letters to OCR')
+    parser.add_argument('--pdf-pages', type=int, default=3, help='Pages in the synthetic PDF')
+    parser.add_argument('--skip-ocr', action='store_true', help='Skip OCR and PDF stages')
+    parser.add_argument('--ocr-quality', default=','.join(preprocessing.QUALITY_PRESETS),
+                        help='Comma-separated preprocessing presets to compare')
+    parser.add_argument('--photo-scale', type=float, default=2.5,
+                        help='Upscale rendered pages by this much to mimic phone photos for the preset comparison')
+    parser.add_argument('--embedding-backends', default='',
+                        help='Comma-separated embedding backends to compare (e.g. torch,torch-int8,onnx,onnx-int8)')
+    parser.add_argument('--embedding-count', type=int, default=1000, help='Reasons encoded per backend comparison run')
+    parser.add_argument('--max-matrix', type=int, default=20000,
+                        help='Largest size for which the dense similarity matrix is benchmarked (for comparison)')
+    parser.add_argument('--trace-memory', action='store_true', help='Report traced peak memory per stage (slower)')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args(argv)
+
+    bench = Bench(args.repeats, args.trace_memory)
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'embedding_model': app.EMBEDDING_MODEL_NAME,
+            'ocr_quality': app.OCR_QUALITY,
+            'embedding_backend': app.EMBEDDING_BACKEND,
+            'embedding_batch_size': app.EMBEDDING_BATCH_SIZE,
+            'args': vars(args)
+        },
+        'ocr': None,
+        'embedding_backends': None,
+        'sizes': {}
+    }
+
+    # The service logs with print; keep stdout clean for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        if not args.skip_ocr:
+            print(f'Benchmarking OCR on {args.ocr_samples} letters...')
+            qualities = [value.strip() for value in args.ocr_quality.split(',') if value.strip()]
+            report['ocr'] = bench_ocr(bench, args.ocr_samples, args.pdf_pages, qualities, args.photo_scale)
+
+        backends = [value.strip() for value in args.embedding_backends.split(',') if value.strip()]
+        if backends:
+            report['embedding_backends'] = bench_embedding_backends(
+                bench, backends, args.embedding_count, app.EMBEDDING_BATCH_SIZE
+            )
+    
+        for size in [int(value) for value in args.sizes.split(',') if value.strip()]:
+            print(f'Benchmarking analysis of {size} letters...')
+            report['sizes'][str(size)] = bench_analysis(bench, size, args.max_matrix)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
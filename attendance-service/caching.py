@@ -0,0 +1,230 @@
+"""
+Persistent caches for the attendance analysis service
+Embeddings and OCR results are stored content-addressed so repeated inputs skip the models
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Any, BinaryIO
+
+import numpy as np
+
+# SQLite limits the number of bound parameters per statement
+SQLITE_MAX_PARAMS = 500
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_reason(text: Optional[str]) -> str:
+    """Normalize reason text before hashing so formatting-only changes share a cache entry"""
+    return _WHITESPACE.sub(' ', text or '').strip()
+
+def embedding_key(text: str, model_name: str) -> str:
+    """Content address of a (normalized text, model) pair"""
+    return hashlib.sha256(f'{model_name}\x00{text}'.encode('utf-8')).hexdigest()
+
+def file_digest(file_obj: BinaryIO, chunk_size: int = 64 * 1024) -> str:
+    """SHA-256 of a seekable file object's contents, leaving it rewound"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+class SQLiteStore:
+    """Lazily opened SQLite connection that is reopened after a fork"""
+
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self.schema = schema
+        self._conn = None
+        self._pid = None
+
+    def connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(self.schema)
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+class EmbeddingCache:
+    """Bounded in-memory LRU in front of an on-disk SQLite embedding store"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL
+        );
+    '''
+
+    def __init__(self, path: Optional[str], max_memory_items: int = 20000):
+        self.max_memory_items = max_memory_items
+        self._store = SQLiteStore(path, self.SCHEMA) if path else None
+        self._memory: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Return the cached vectors for whichever keys are present"""
+        found = {}
+        with self._lock:
+            pending = []
+            for key in dict.fromkeys(keys):
+                vector = self._memory.get(key)
+                if vector is None:
+                    pending.append(key)
+                else:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            self.memory_hits += len(found)
+
+            if pending and self._store is not None:
+                conn = self._store.connection()
+                for start in range(0, len(pending), SQLITE_MAX_PARAMS):
+                    chunk = pending[start:start + SQLITE_MAX_PARAMS]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = conn.execute(
+                        f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, vector)
+                        found[key] = vector
+                        self.disk_hits += 1
+
+            self.misses += sum(1 for key in pending if key not in found)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        """Store freshly computed vectors in memory and on disk"""
+        if not items:
+            return
+        rows = []
+        with self._lock:
+            for key, vector in items.items():
+                vector = np.ascontiguousarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((key, int(vector.shape[0]), vector.tobytes()))
+            if self._store is not None:
+                conn = self._store.connection()
+                conn.executemany(
+                    'INSERT OR REPLACE INTO embeddings (key, dim, vector) VALUES (?, ?, ?)', rows
+                )
+                conn.commit()
+
+    def clear_memory(self):
+        """Drop the in-memory layer; the on-disk store is kept"""
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters since startup"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_items': len(self._memory),
+                'max_memory_items': self.max_memory_items,
+                'path': self._store.path if self._store else None
+            }
+
+class OcrResultCache:
+    """On-disk OCR/extraction results keyed by file content and OCR settings, evicted by total size"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS ocr_results (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ocr_results_last_access ON ocr_results (last_access);
+    '''
+
+    def __init__(self, path: Optional[str], max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._store = SQLiteStore(path, self.SCHEMA) if path else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(content_digest: str, settings: str) -> str:
+        """Cache key for a file digest under the given OCR settings"""
+        return hashlib.sha256(f'{settings}\x00{content_digest}'.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Stored result for key, or None"""
+        if self._store is None:
+            return None
+        with self._lock:
+            conn = self._store.connection()
+            row = conn.execute('SELECT result FROM ocr_results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute('UPDATE ocr_results SET last_access = ? WHERE key = ?', (time.time(), key))
+            conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, result: Dict[str, Any]):
+        """Store a result, evicting least recently used entries beyond max_bytes"""
+        if self._store is None:
+            return
+        payload = json.dumps(result)
+        with self._lock:
+            conn = self._store.connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO ocr_results (key, result, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, payload, len(payload), time.time())
+            )
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM ocr_results').fetchone()[0]
+            if total > self.max_bytes:
+                rows = conn.execute('SELECT key, size FROM ocr_results ORDER BY last_access').fetchall()
+                evicted = []
+                for old_key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    total -= size
+                conn.executemany('DELETE FROM ocr_results WHERE key = ?', evicted)
+                self.evictions += len(evicted)
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters since startup"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'max_bytes': self.max_bytes,
+                'path': self._store.path if self._store else None
+            }
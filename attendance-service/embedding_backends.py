@@ -0,0 +1,141 @@
+"""
+Inference backends for the sentence embedding model
+  torch       SentenceTransformer in float32 (the reference)
+  torch-int8  the same model with its Linear layers dynamically quantized to int8
+  onnx        the transformer exported to ONNX and run with ONNX Runtime
+  onnx-int8   the ONNX export with dynamically quantized int8 weights
+ONNX backends need onnxruntime at run time, and torch once to export the model.
+"""
+import os
+import json
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+
+class TorchBackend:
+    """SentenceTransformer, optionally with dynamic int8 quantization"""
+
+    def __init__(self, model_name: str, quantize: bool = False):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        if quantize:
+            import torch
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        # SentenceTransformer already batches texts sorted by length
+        return self.model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+
+def export_onnx(model_name: str, directory: str, quantize: bool = False) -> str:
+    """Export the model's transformer, tokenizer and pooling settings to directory (once)"""
+    model_path = os.path.join(directory, 'model-int8.onnx' if quantize else 'model.onnx')
+    if os.path.exists(model_path):
+        return model_path
+    os.makedirs(directory, exist_ok=True)
+
+    float_path = os.path.join(directory, 'model.onnx')
+    if not os.path.exists(float_path):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name, device='cpu')
+        transformer, pooling = model[0], model[1]
+        if not pooling.pooling_mode_mean_tokens:
+            raise ValueError(f'ONNX export supports mean pooling only ({model_name})')
+
+        transformer.tokenizer.save_pretrained(directory)
+        with open(os.path.join(directory, 'pooling.json'), 'w') as f:
+            json.dump({
+                'max_seq_length': transformer.max_seq_length,
+                'normalize': any(type(module).__name__ == 'Normalize' for module in model)
+            }, f)
+
+        sample = transformer.tokenizer(['export sample'], return_tensors='pt')
+        inputs = ('input_ids', 'attention_mask', 'token_type_ids')
+        dynamic = {'batch': 0, 'sequence': 1}
+        # Written to a temporary name so an interrupted export isn't mistaken for a finished one
+        torch.onnx.export(
+            transformer.auto_model,
+            tuple(sample[name] for name in inputs),
+            float_path + '.tmp',
+            input_names=list(inputs),
+            output_names=['last_hidden_state'],
+            dynamic_axes={**{name: dynamic for name in inputs}, 'last_hidden_state': dynamic},
+            opset_version=14
+        )
+        os.replace(float_path + '.tmp', float_path)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(float_path, model_path + '.tmp', weight_type=QuantType.QInt8)
+        os.replace(model_path + '.tmp', model_path)
+    return model_path
+
+class OnnxBackend:
+    """Exported transformer on ONNX Runtime, with mean pooling done in numpy"""
+
+    def __init__(self, model_name: str, export_dir: str, quantize: bool = False):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        model_path = export_onnx(model_name, export_dir, quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        with open(os.path.join(export_dir, 'pooling.json')) as f:
+            pooling = json.load(f)
+        self.max_seq_length = pooling['max_seq_length']
+        self.normalize = pooling['normalize']
+
+        options = onnxruntime.SessionOptions()
+        # Respect the per-worker thread split (see gunicorn.conf.py); 0 lets ONNX Runtime decide
+        options.intra_op_num_threads = int(os.environ.get('OMP_NUM_THREADS', 0))
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        tokens = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length,
+                                return_tensors='np')
+        feed = {name: tokens[name].astype(np.int64) for name in self.input_names if name in tokens}
+        hidden = self.session.run(['last_hidden_state'], feed)[0]
+        mask = tokens['attention_mask'][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype(np.float32)
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        # Length buckets: batches of similar-length texts pad to less
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        batches = [
+            self._encode_batch([texts[idx] for idx in order[start:start + batch_size]])
+            for start in range(0, len(texts), batch_size)
+        ]
+        embeddings = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.concatenate(batches)
+        return embeddings
+
+def load_backend(name: str, model_name: str, cache_dir: str):
+    """Instantiate an embedding backend by name"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}' (expected one of {', '.join(BACKENDS)})")
+    if name.startswith('onnx'):
+        return OnnxBackend(model_name, os.path.join(cache_dir, 'onnx', model_name), quantize=name == 'onnx-int8')
+    return TorchBackend(model_name, quantize=name == 'torch-int8')
+
+# Leave-letter style sentences for parity checks
+PARITY_SENTENCES = [
+    'I was unable to attend classes yesterday due to high fever.',
+    'I request leave for three days to attend my sister\'s wedding.',
+    'Due to personal reasons I could not come to college.',
+    'My grandmother was hospitalized and I had to accompany her.',
+    'I met with a minor accident while travelling to college and injured my leg.',
+    'There was a death in the family and we had to travel for the funeral.',
+]
+
+def parity_check(candidate, reference, sentences: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Cosine similarity between a backend's embeddings and the float32 reference's"""
+    sentences = sentences or PARITY_SENTENCES
+    a, b = candidate.encode(sentences), reference.encode(sentences)
+    cosines = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return {'min_cosine': float(cosines.min()), 'mean_cosine': float(cosines.mean()), 'sentences': len(sentences)}
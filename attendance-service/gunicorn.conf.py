@@ -0,0 +1,48 @@
+"""
+Gunicorn configuration for running the attendance service in production
+Models are loaded in the master before workers fork so their weights are shared copy-on-write
+"""
+import gc
+import os
+
+cpu_count = os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+# Analysis jobs are kept in SQLite (ANALYSIS_JOB_DB_PATH), so any worker can answer a status poll.
+# Analysis sessions (/api/analysis-sessions) and clustering warm starts stay per worker.
+workers = int(os.environ.get('WEB_CONCURRENCY', max(1, cpu_count // 2)))
+threads = int(os.environ.get('GUNICORN_THREADS', 2))
+worker_class = 'gthread'
+# Analyses of large batches can legitimately take minutes
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+preload_app = True
+
+# Split the cores between workers so torch, paddle and BLAS thread pools don't oversubscribe.
+# This file runs before the app is imported, so numpy/torch pick these up at import time.
+THREADS_PER_WORKER = int(os.environ.get('THREADS_PER_WORKER', max(1, cpu_count // workers)))
+for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                 'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS'):
+    os.environ.setdefault(variable, str(THREADS_PER_WORKER))
+# Not OCR_CPU_THREADS: the app splits THREADS_PER_WORKER (via OMP_NUM_THREADS) between its OCR processes
+os.environ.setdefault('OCR_WORKERS', str(max(1, cpu_count // workers)))
+
+def when_ready(server):
+    """Load model weights once in the master, before any worker is forked"""
+    import app
+    # Warm-up inference starts thread pools, which must not cross a fork; workers warm up themselves
+    app.preload_models(warmup=False)
+    # Keep the loaded objects out of the collector so workers don't copy their pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    """Apply per-worker thread limits and warm up the inherited models"""
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(THREADS_PER_WORKER)
+    try:
+        import torch
+        torch.set_num_threads(THREADS_PER_WORKER)
+    except ImportError:
+        pass
+
+    import app
+    app.preload_models()
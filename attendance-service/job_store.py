@@ -0,0 +1,152 @@
+"""
+Shared state of background analysis jobs
+Jobs run on a thread of the server worker that accepted them, but their state lives in SQLite,
+so a status poll answered by any other worker (or process) sees the same job.
+"""
+import os
+import json
+import time
+import threading
+from typing import Dict, Optional, Any, Tuple
+
+from caching import SQLiteStore
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class AnalysisJobStore:
+    """Analysis jobs keyed by id, deduplicated by input hash, with the oldest finished jobs pruned
+    once there are more than history of them or their results exceed max_result_bytes"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS analysis_jobs (
+            job_id TEXT PRIMARY KEY,
+            input_hash TEXT NOT NULL,
+            status TEXT NOT NULL,
+            state TEXT NOT NULL,
+            result TEXT,
+            result_size INTEGER NOT NULL DEFAULT 0,
+            worker_pid INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS analysis_jobs_input_hash ON analysis_jobs (input_hash);
+        CREATE INDEX IF NOT EXISTS analysis_jobs_created ON analysis_jobs (created);
+    '''
+
+    def __init__(self, path: Optional[str], history: int = 100, max_result_bytes: int = 256 * 1024 * 1024):
+        # Without a path the jobs are only visible to this process
+        self._store = SQLiteStore(path or ':memory:', self.SCHEMA)
+        self._lock = threading.Lock()
+        self.history = history
+        self.max_result_bytes = max_result_bytes
+
+    def _fail_if_orphaned(self, conn, job_id: str, status: str, worker_pid: int, state: Dict[str, Any]) -> Dict[str, Any]:
+        """A queued or running job whose worker has exited will never finish: mark it failed"""
+        if status in ACTIVE_STATUSES and not _process_alive(worker_pid):
+            state.update({'status': 'failed', 'error': 'Worker exited before the job finished'})
+            conn.execute(
+                'UPDATE analysis_jobs SET status = ?, state = ? WHERE job_id = ?',
+                ('failed', json.dumps(state), job_id)
+            )
+        return state
+
+    def submit(self, input_hash: str, job: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """Store job unless an unfailed job for the same input exists; returns (job, whether it is new)"""
+        with self._lock:
+            conn = self._store.connection()
+            # Take the write lock up front so two workers can't both decide the job is new
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    "SELECT job_id, status, worker_pid, state FROM analysis_jobs "
+                    "WHERE input_hash = ? AND status != 'failed' ORDER BY created DESC",
+                    (input_hash,)
+                ).fetchall()
+                for job_id, status, worker_pid, state in rows:
+                    existing = self._fail_if_orphaned(conn, job_id, status, worker_pid, json.loads(state))
+                    if existing['status'] != 'failed':
+                        conn.commit()
+                        return existing, False
+                conn.execute(
+                    'INSERT INTO analysis_jobs (job_id, input_hash, status, state, worker_pid, created) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (job['job_id'], input_hash, job['status'], json.dumps(job), os.getpid(), time.time())
+                )
+                self._prune(conn)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return job, True
+
+    def _prune(self, conn):
+        """Forget the oldest finished jobs beyond the history and result size limits"""
+        total = conn.execute('SELECT COUNT(*) FROM analysis_jobs').fetchone()[0]
+        if total > self.history:
+            conn.execute(
+                "DELETE FROM analysis_jobs WHERE job_id IN (SELECT job_id FROM analysis_jobs "
+                "WHERE status IN ('completed', 'failed') ORDER BY created LIMIT ?)",
+                (total - self.history,)
+            )
+        # Keep the newest results that fit; the newest one is kept even if it alone is larger
+        rows = conn.execute(
+            'SELECT job_id, result_size FROM analysis_jobs WHERE result_size > 0 ORDER BY created DESC'
+        ).fetchall()
+        retained = 0
+        evicted = []
+        for job_id, size in rows:
+            retained += size
+            if retained > self.max_result_bytes and retained > size:
+                evicted.append((job_id,))
+        if evicted:
+            conn.executemany('DELETE FROM analysis_jobs WHERE job_id = ?', evicted)
+
+    def update(self, job_id: str, **fields: Any):
+        """Change a job's public fields; a 'result' field is stored alongside them"""
+        result = fields.pop('result', None)
+        result = json.dumps(result) if result is not None else None
+        with self._lock:
+            conn = self._store.connection()
+            row = conn.execute('SELECT state FROM analysis_jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                return
+            state = {**json.loads(row[0]), **fields}
+            conn.execute(
+                'UPDATE analysis_jobs SET status = ?, state = ?, result = COALESCE(?, result), '
+                'result_size = COALESCE(?, result_size) WHERE job_id = ?',
+                (state['status'], json.dumps(state), result, len(result) if result is not None else None, job_id)
+            )
+            if result is not None:
+                self._prune(conn)
+            conn.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """A job's public fields, with the result once completed"""
+        with self._lock:
+            conn = self._store.connection()
+            row = conn.execute(
+                'SELECT status, worker_pid, state, result FROM analysis_jobs WHERE job_id = ?', (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            status, worker_pid, state, result = row
+            job = self._fail_if_orphaned(conn, job_id, status, worker_pid, json.loads(state))
+            conn.commit()
+        if job['status'] == 'completed' and result is not None:
+            job['result'] = json.loads(result)
+        return job
+
+    def active_count(self) -> int:
+        """Jobs queued or running on any worker"""
+        with self._lock:
+            return self._store.connection().execute(
+                'SELECT COUNT(*) FROM analysis_jobs WHERE status IN (?, ?)', ACTIVE_STATUSES
+            ).fetchone()[0]
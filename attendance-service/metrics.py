@@ -0,0 +1,152 @@
+"""
+In-process metrics for the attendance analysis service
+Counters and histograms rendered in Prometheus text format, plus per-request stage timings
+Each server process keeps its own metrics
+"""
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Dict, Any, Optional, Tuple, Iterator, Callable, List
+
+# Seconds; covers fast regex stages up to multi-minute analyses
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# Bytes; from small JSON bodies to large scanned PDFs
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Stage durations of the request (or job) currently running in this context
+_current_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('current_timings', default=None)
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Metrics:
+    """Thread-safe registry of counters and histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, List[float]]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+
+    def counter(self, name: str, description: str):
+        """Declare a counter"""
+        with self._lock:
+            self._help[name] = ('counter', description)
+            self._counters.setdefault(name, {})
+
+    def histogram(self, name: str, description: str, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        """Declare a histogram"""
+        with self._lock:
+            self._help[name] = ('histogram', description)
+            self._histograms.setdefault(name, {})
+            self._buckets[name] = buckets
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add to a counter"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record a histogram observation"""
+        key = _label_key(labels)
+        buckets = self._buckets[name]
+        with self._lock:
+            series = self._histograms[name]
+            # Per-bucket counts followed by total count and sum
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0.0] * (len(buckets) + 2)
+            for idx, bound in enumerate(buckets):
+                if value <= bound:
+                    state[idx] += 1
+            state[-2] += 1
+            state[-1] += value
+
+    def render(self, gauges: Optional[Dict[str, Tuple[str, float]]] = None) -> str:
+        """Prometheus text exposition of everything recorded, plus point-in-time gauges"""
+        lines = []
+        with self._lock:
+            for name, series in self._counters.items():
+                lines.append(f'# HELP {name} {self._help[name][1]}')
+                lines.append(f'# TYPE {name} counter')
+                for key, value in series.items():
+                    lines.append(f'{name}{_format_labels(key)} {value:g}')
+            for name, series in self._histograms.items():
+                buckets = self._buckets[name]
+                lines.append(f'# HELP {name} {self._help[name][1]}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, state in series.items():
+                    for bound, count in zip(buckets, state):
+                        lines.append(f'{name}_bucket{_format_labels(key, ("le", f"{bound:g}"))} {count:g}')
+                    lines.append(f'{name}_bucket{_format_labels(key, ("le", "+Inf"))} {state[-2]:g}')
+                    lines.append(f'{name}_count{_format_labels(key)} {state[-2]:g}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {state[-1]:.6f}')
+        for name, (description, value) in (gauges or {}).items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('attendance_stage_duration_seconds', 'Time spent in each pipeline stage')
+metrics.histogram('attendance_request_duration_seconds', 'HTTP request latency')
+metrics.histogram('attendance_request_size_bytes', 'HTTP request body size', SIZE_BUCKETS)
+metrics.histogram('attendance_response_size_bytes', 'HTTP response body size', SIZE_BUCKETS)
+metrics.counter('attendance_requests_total', 'HTTP requests handled')
+metrics.counter('attendance_ocr_pages_total', 'Pages run through OCR')
+metrics.counter('attendance_letters_analyzed_total', 'Leave letters analyzed')
+
+def begin_timings() -> Tuple[Dict[str, float], Token]:
+    """Start collecting stage durations in the current context (e.g. a request)"""
+    timings: Dict[str, float] = {}
+    return timings, _current_timings.set(timings)
+
+def end_timings(token: Token):
+    """Stop collecting stage durations started by begin_timings"""
+    _current_timings.reset(token)
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """Collect stage durations for everything run inside the block"""
+    timings, token = begin_timings()
+    try:
+        yield timings
+    finally:
+        end_timings(token)
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """Time a pipeline stage into the stage histogram and the current request's timings"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('attendance_stage_duration_seconds', elapsed, stage=stage)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+def timed_stage(stage: str) -> Callable[[Callable], Callable]:
+    """Decorator form of stage_timer"""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,142 @@
+"""
+Image preprocessing before OCR
+Normalizes mode and orientation, then shrinks pages so text lines are about a target height:
+detection time grows with pixel count, while recognition only needs legible lines.
+"""
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Quality/speed presets for OCR_QUALITY
+# text_height: target height in pixels of a text line (pages are only ever shrunk)
+# max_side: cap on the longest side, applied even when no text lines are found
+QUALITY_PRESETS: Dict[str, Dict[str, Any]] = {
+    'off': {'text_height': None, 'max_side': None, 'crop_margins': False, 'deskew': False},
+    'fast': {'text_height': 20, 'max_side': 1600, 'crop_margins': True, 'deskew': False},
+    'balanced': {'text_height': 32, 'max_side': 2400, 'crop_margins': True, 'deskew': False},
+    'accurate': {'text_height': 48, 'max_side': 3200, 'crop_margins': True, 'deskew': True},
+}
+# Bump when the preprocessing itself changes, so cached OCR output is recomputed
+PREPROCESS_VERSION = 1
+
+# Page layout is measured on a copy at most this wide
+ANALYSIS_WIDTH = 1000
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_STEP = 0.5
+MARGIN_PADDING = 0.02
+
+def preset(quality: str) -> Dict[str, Any]:
+    """Settings of a quality preset"""
+    if quality not in QUALITY_PRESETS:
+        raise ValueError(f"Unknown OCR quality '{quality}' (expected one of {', '.join(QUALITY_PRESETS)})")
+    return QUALITY_PRESETS[quality]
+
+def describe(quality: str) -> str:
+    """Stable description of a preset, for cache keys"""
+    settings = ','.join(f'{key}={value}' for key, value in sorted(preset(quality).items()))
+    return f'{quality}({settings});v{PREPROCESS_VERSION}'
+
+def to_rgb(image: Image.Image) -> Image.Image:
+    """RGB copy of any PIL mode; transparent areas become white paper"""
+    if image.mode == 'RGB':
+        return image
+    if image.mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    if image.mode in ('RGBA', 'LA', 'PA'):
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+        return background
+    if image.mode in ('I', 'I;16', 'F'):
+        # 16-bit and float scans: stretch to 8 bits first
+        pixels = np.asarray(image, dtype=np.float32)
+        span = float(pixels.max() - pixels.min()) or 1.0
+        image = Image.fromarray(((pixels - pixels.min()) * (255.0 / span)).astype(np.uint8))
+    return image.convert('RGB')
+
+def _ink_mask(image: Image.Image) -> Tuple[np.ndarray, float]:
+    """Dark-pixel mask of a reduced grayscale copy, and the reduction factor"""
+    # Integer box reduction is far cheaper than resampling a multi-megapixel photo
+    factor = -(-image.width // ANALYSIS_WIDTH)
+    reduced = image.reduce(factor) if factor > 1 else image
+    scale = reduced.width / image.width
+    gray = reduced.convert('L')
+    pixels = np.asarray(gray, dtype=np.float32)
+    # Ink is clearly darker than the page; threshold halfway between the two
+    paper = float(np.percentile(pixels, 90))
+    # Text covers only a few percent of a page, so take the darkest sliver as ink
+    ink = float(np.percentile(pixels, 0.1))
+    if paper - ink < 30:
+        return np.zeros(pixels.shape, dtype=bool), scale
+    return pixels < (paper + ink) / 2, scale
+
+def estimate_text_height(mask: np.ndarray) -> Optional[float]:
+    """Median height of text lines, from runs of rows containing ink"""
+    row_ink = mask.mean(axis=1)
+    text_rows = row_ink > max(0.005, 0.1 * float(row_ink.max(initial=0.0)))
+    # Lengths of consecutive runs of text rows
+    edges = np.diff(np.concatenate(([0], text_rows.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    heights = ends - starts
+    heights = heights[heights >= 2]
+    if len(heights) < 3:
+        return None
+    return float(np.median(heights))
+
+def estimate_skew(mask: np.ndarray) -> float:
+    """Angle in degrees that makes text rows sharpest (largest row-profile variance)"""
+    if not mask.any():
+        return 0.0
+    page = Image.fromarray(mask.astype(np.uint8) * 255)
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + DESKEW_STEP / 2, DESKEW_STEP):
+        rotated = np.asarray(page.rotate(float(angle), resample=Image.NEAREST), dtype=np.float32)
+        score = float(rotated.mean(axis=1).var())
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+def ink_bbox(mask: np.ndarray, scale: float, size: Tuple[int, int]) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box of the ink in full-size coordinates, padded a little"""
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    width, height = size
+    pad_x, pad_y = round(width * MARGIN_PADDING), round(height * MARGIN_PADDING)
+    return (
+        max(0, int(cols[0] / scale) - pad_x),
+        max(0, int(rows[0] / scale) - pad_y),
+        min(width, int((cols[-1] + 1) / scale) + pad_x),
+        min(height, int((rows[-1] + 1) / scale) + pad_y)
+    )
+
+def preprocess_for_ocr(image: Image.Image, quality: str = 'balanced') -> Image.Image:
+    """Prepare a page for OCR: RGB, upright, optionally deskewed and cropped, shrunk to the target text height"""
+    settings = preset(quality)
+    image = to_rgb(ImageOps.exif_transpose(image))
+    if quality == 'off':
+        return image
+
+    mask, scale = _ink_mask(image)
+    if settings['deskew']:
+        angle = estimate_skew(mask)
+        if angle:
+            image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor='white')
+            mask, scale = _ink_mask(image)
+    if settings['crop_margins']:
+        bbox = ink_bbox(mask, scale, image.size)
+        if bbox is not None and bbox != (0, 0) + image.size:
+            top, bottom = int(bbox[1] * scale), int(np.ceil(bbox[3] * scale))
+            image = image.crop(bbox)
+            mask = mask[top:bottom, int(bbox[0] * scale):int(np.ceil(bbox[2] * scale))]
+
+    factor = 1.0
+    text_height = estimate_text_height(mask)
+    if settings['text_height'] and text_height:
+        factor = min(factor, settings['text_height'] / (text_height / scale))
+    if settings['max_side']:
+        factor = min(factor, settings['max_side'] / max(image.size))
+    if factor < 1.0:
+        size = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+        image = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    return image
@@ -0,0 +1,165 @@
+"""
+Compact cosine-similarity index over leave-reason embeddings
+Keeps one normalized copy of the embeddings (float32 or float16, memory-mapped for large batches)
+and computes similarities tile by tile on demand, so memory grows linearly with the number of letters
+instead of holding an n x n matrix.
+"""
+import tempfile
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+from sklearn.preprocessing import normalize
+
+from metrics import timed_stage
+
+class SimilarityIndex:
+    """Normalized embeddings with tiled similarity queries"""
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        dtype: str = 'float32',
+        mmap: bool = False,
+        mmap_dir: Optional[str] = None,
+        block_size: int = 512
+    ):
+        self.block_size = block_size
+        self.dtype = dtype
+        self.mmap_dir = mmap_dir
+        self._file = None
+        self.vectors = np.empty((0, embeddings.shape[1] if len(embeddings) else 0), dtype=dtype)
+        self.append(embeddings, mmap)
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def __enter__(self) -> 'SimilarityIndex':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, embeddings: np.ndarray, mmap: bool = False):
+        """Add letters at the end; with mmap the vectors move to a memory-mapped file, and stay there"""
+        if len(embeddings) == 0:
+            return
+        old, size = len(self.vectors), self.block_size
+        shape = (old + len(embeddings), embeddings.shape[1])
+        file = None
+        if mmap or self._file is not None:
+            # Anonymous temp file: removed by the OS once closed, even if the process dies
+            file = tempfile.TemporaryFile(dir=self.mmap_dir)
+            vectors = np.memmap(file, dtype=self.dtype, mode='w+', shape=shape)
+        else:
+            vectors = np.empty(shape, dtype=self.dtype)
+        for start in range(0, old, size):
+            stop = min(start + size, old)
+            vectors[start:stop] = self.vectors[start:stop]
+        # Normalize a block at a time so no full float64 copy is made
+        for start in range(0, len(embeddings), size):
+            block = np.asarray(embeddings[start:start + size], dtype=np.float32)
+            vectors[old + start:old + start + size] = normalize(block)
+        self.close()
+        self.vectors, self._file = vectors, file
+
+    def close(self):
+        """Release the memory map's backing file"""
+        if self._file is not None:
+            self.vectors = None
+            self._file.close()
+            self._file = None
+
+    def _rows(self, start: int, stop: int) -> np.ndarray:
+        return np.asarray(self.vectors[start:stop], dtype=np.float32)
+
+    def similarity(self, i: int, j: int) -> float:
+        """Cosine similarity of two letters"""
+        return float(self._rows(i, i + 1)[0] @ self._rows(j, j + 1)[0])
+
+    @timed_stage('similar_pairs')
+    def pairs_above(self, threshold: float, start: int = 0) -> List[Tuple[int, int, float]]:
+        """All pairs (i < j) with similarity >= threshold and j >= start, in row-major order
+
+        Only a block_size x block_size tile of the similarity matrix exists at any time.
+        With start, only letters appended from start on are compared (with everything),
+        which is O(new * n) instead of O(n^2).
+        """
+        if start > 0:
+            return self._pairs_from(threshold, start)
+        n, size = len(self), self.block_size
+        pairs = []
+        for row_start in range(0, n, size):
+            rows = self._rows(row_start, row_start + size)
+            row_pairs = []
+            # Tiles left of the diagonal only hold pairs with i > j
+            for col_start in range(row_start, n, size):
+                tile = rows @ self._rows(col_start, col_start + size).T
+                tile_rows, tile_cols = np.nonzero(tile >= threshold)
+                upper = tile_cols + col_start > tile_rows + row_start
+                tile_rows, tile_cols = tile_rows[upper], tile_cols[upper]
+                row_pairs.append((tile_rows + row_start, tile_cols + col_start, tile[tile_rows, tile_cols]))
+            first = np.concatenate([p[0] for p in row_pairs])
+            second = np.concatenate([p[1] for p in row_pairs])
+            scores = np.concatenate([p[2] for p in row_pairs])
+            order = np.lexsort((second, first))
+            pairs.extend(zip(first[order].tolist(), second[order].tolist(), scores[order].tolist()))
+        return pairs
+
+    def _pairs_from(self, threshold: float, start: int) -> List[Tuple[int, int, float]]:
+        n, size = len(self), self.block_size
+        found = []
+        for row_start in range(start, n, size):
+            rows = self._rows(row_start, row_start + size)
+            row_stop = row_start + len(rows)
+            # Each new row against every earlier row: tiles up to and including the diagonal
+            for col_start in range(0, row_stop, size):
+                tile = rows @ self._rows(col_start, min(col_start + size, row_stop)).T
+                tile_rows, tile_cols = np.nonzero(tile >= threshold)
+                lower = tile_cols + col_start < tile_rows + row_start
+                tile_rows, tile_cols = tile_rows[lower], tile_cols[lower]
+                found.append((tile_cols + col_start, tile_rows + row_start, tile[tile_rows, tile_cols]))
+        if not found:
+            return []
+        first = np.concatenate([p[0] for p in found])
+        second = np.concatenate([p[1] for p in found])
+        scores = np.concatenate([p[2] for p in found])
+        order = np.lexsort((second, first))
+        return list(zip(first[order].tolist(), second[order].tolist(), scores[order].tolist()))
+
+    def mean_similarity(self, indices: np.ndarray) -> float:
+        """Mean similarity over pairs i < j of the given letters (1.0 for fewer than two)
+
+        The squared norm of the summed vectors counts each pair twice plus the
+        diagonal, so this is O(len(indices)) rather than quadratic.
+        """
+        # Sorted, so a memory-mapped index is read front to back
+        indices = np.sort(np.asarray(indices))
+        count = len(indices)
+        if count < 2:
+            return 1.0
+        total = np.zeros(self.vectors.shape[1], dtype=np.float64)
+        diagonal = 0.0
+        for start in range(0, count, self.block_size):
+            block = np.asarray(self.vectors[indices[start:start + self.block_size]], dtype=np.float64)
+            total += block.sum(axis=0)
+            diagonal += float((block * block).sum())
+        return float((total @ total - diagonal) / (count * (count - 1)))
+
+    def peer_scores(self, members: np.ndarray, limit: Optional[int] = None) -> List[Dict[int, float]]:
+        """Similarity of each member to the other members: all of them in index order, or the top `limit`"""
+        members = np.asarray(members)
+        vectors = np.asarray(self.vectors[members], dtype=np.float32)
+        scores = []
+        for start in range(0, len(members), self.block_size):
+            block = vectors[start:start + self.block_size] @ vectors.T
+            for offset, row in enumerate(block):
+                row[start + offset] = -np.inf
+                if limit is None:
+                    order = np.arange(len(members))
+                    order = order[order != start + offset]
+                else:
+                    k = min(limit, len(members) - 1)
+                    order = np.argpartition(-row, k - 1)[:k] if k > 0 else np.zeros(0, dtype=int)
+                    order = order[np.argsort(-row[order], kind='stable')]
+                scores.append({int(members[j]): float(row[j]) for j in order})
+        return scores
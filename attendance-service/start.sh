@@ -9,5 +9,10 @@ fi
 # Set default port if not specified
 export PORT=${PORT:-5001}
 
+# APP_ENV=production runs multiple gunicorn workers (see gunicorn.conf.py)
+if [ "$APP_ENV" = "production" ]; then
+    exec gunicorn -c gunicorn.conf.py app:app
+fi
+
 # Start the Flask service
 python app.py
@@ -0,0 +1,134 @@
+"""
+Persistent per-student history of leave reasons
+Every analyzed letter is stored once per embedding model, keyed by a hash of student, date and reason,
+with its normalized reason embedding. A new letter is then compared only against the same student's
+letters near its date, instead of the client resending every past letter with each request.
+"""
+import time
+import hashlib
+import threading
+from typing import List, Dict, Iterable, Optional, Any, Set
+
+import numpy as np
+from dateutil import parser as date_parser
+
+from caching import SQLiteStore, normalize_reason
+
+def student_key(value: Any) -> Optional[str]:
+    """Case- and spacing-insensitive student identifier (roll number or name), None when missing"""
+    key = ' '.join(str(value or '').split()).lower()
+    return key or None
+
+def parse_letter_date(text: Any) -> Optional[int]:
+    """Day number (date ordinal) of a letter's date, read day first (01/02/2024 is 1 February), or None"""
+    if not text:
+        return None
+    try:
+        return date_parser.parse(str(text), dayfirst=True).date().toordinal()
+    except (ValueError, OverflowError):
+        return None
+
+def letter_hash(key: str, date: Any, reason: Optional[str]) -> str:
+    """Identity of a letter, so a letter sent again is stored and counted once"""
+    content = f'{key}\x00{date or ""}\x00{normalize_reason(reason)}'
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+class StudentHistory:
+    """SQLite store of past letters and their embeddings, indexed by student and day"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS student_letters (
+            student_key TEXT NOT NULL,
+            letter_hash TEXT NOT NULL,
+            day INTEGER,
+            date TEXT,
+            student_name TEXT,
+            reason TEXT NOT NULL,
+            model TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (student_key, model, letter_hash)
+        );
+        CREATE INDEX IF NOT EXISTS student_letters_day ON student_letters (student_key, model, day);
+    '''
+
+    def __init__(self, path: Optional[str], model: str):
+        # Vectors from different embedding models are not comparable, so each row records its model
+        # and a letter is stored once per model
+        self.model = model
+        self._store = SQLiteStore(path, self.SCHEMA) if path else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._store is not None
+
+    def record(self, entries: Iterable[Dict[str, Any]]) -> int:
+        """Store letters (see app.history_entries) not seen before; returns how many were new"""
+        if self._store is None:
+            return 0
+        rows = [
+            (
+                entry['student_key'], entry['letter_hash'], entry['day'], entry['date'],
+                entry['student_name'], entry['reason'], self.model,
+                np.ascontiguousarray(entry['vector'], dtype=np.float32).tobytes(), time.time()
+            )
+            for entry in entries
+        ]
+        if not rows:
+            return 0
+        with self._lock:
+            conn = self._store.connection()
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO student_letters (student_key, letter_hash, day, date, student_name, '
+                'reason, model, vector, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows
+            )
+            conn.commit()
+            return conn.total_changes - before
+
+    def nearby(self, key: str, day: int, window_days: int, exclude: Set[str] = frozenset()) -> List[Dict[str, Any]]:
+        """A student's stored letters dated within window_days of day, with their vectors"""
+        if self._store is None:
+            return []
+        with self._lock:
+            rows = self._store.connection().execute(
+                'SELECT letter_hash, day, date, reason, vector FROM student_letters '
+                'WHERE student_key = ? AND model = ? AND day BETWEEN ? AND ? ORDER BY day',
+                (key, self.model, day - window_days, day + window_days)
+            ).fetchall()
+        return [
+            {'day': row_day, 'date': date, 'reason': reason, 'vector': np.frombuffer(blob, dtype=np.float32)}
+            for digest, row_day, date, reason, blob in rows
+            if digest not in exclude
+        ]
+
+    def history(self, key: str, since_day: Optional[int] = None) -> List[Dict[str, Any]]:
+        """A student's stored letters under any model, oldest first (undated letters last)"""
+        if self._store is None:
+            return []
+        # MIN() picks the other columns from each letter's first recording
+        query = ('SELECT day, date, student_name, reason, MIN(recorded_at) FROM student_letters '
+                 'WHERE student_key = ?')
+        params: List[Any] = [key]
+        if since_day is not None:
+            query += ' AND day >= ?'
+            params.append(since_day)
+        with self._lock:
+            rows = self._store.connection().execute(
+                query + ' GROUP BY letter_hash ORDER BY day IS NULL, day, MIN(recorded_at)', params
+            ).fetchall()
+        return [
+            {'day': day, 'date': date, 'student_name': name, 'reason': reason, 'recorded_at': recorded_at}
+            for day, date, name, reason, recorded_at in rows
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """Stored letter and student counts"""
+        if self._store is None:
+            return {'letters': 0, 'students': 0, 'path': None}
+        with self._lock:
+            letters, students = self._store.connection().execute(
+                'SELECT COUNT(DISTINCT letter_hash), COUNT(DISTINCT student_key) FROM student_letters'
+            ).fetchone()
+        return {'letters': letters, 'students': students, 'path': self._store.path}
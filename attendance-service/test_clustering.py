@@ -0,0 +1,28 @@
+"""
+Regression tests for cluster_reasons
+Run with: python -m pytest test_clustering.py
+"""
+import os
+
+os.environ.setdefault('PRELOAD_MODELS', 'none')
+os.environ.setdefault('EMBEDDING_CACHE_PATH', '')
+os.environ.setdefault('OCR_CACHE_PATH', '')
+os.environ.setdefault('STUDENT_HISTORY_PATH', '')
+
+import numpy as np
+
+import app
+
+def test_silhouette_sample_missing_a_small_cluster():
+    """A cluster outside the silhouette sample scores that k as -1 instead of failing the analysis"""
+    count = app.CLUSTER_SILHOUETTE_SAMPLE + 1000
+    rng = np.random.RandomState(0)
+    embeddings = np.ones((count, 8), dtype=np.float32) + rng.normal(0, 1e-3, (count, 8)).astype(np.float32)
+    # Put one outlier where _score_k's sample won't look
+    sampled = set(np.random.RandomState(42).permutation(count)[:app.CLUSTER_SILHOUETTE_SAMPLE].tolist())
+    outlier = next(idx for idx in range(count) if idx not in sampled)
+    embeddings[outlier] = -1.0
+
+    labels = app.cluster_reasons(embeddings, class_id='regression-silhouette-sample')
+
+    assert len(labels) == count
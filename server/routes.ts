@@ -943,6 +943,35 @@ export async function registerRoutes(
     }
   }
 
+  // Large analyses run as background jobs on the Python service; poll until done
+  async function analyzeWithAttendanceService(leave_letters: any[]) {
+    const job = await callAttendanceService("/api/analyze-leave-letters", {
+      leave_letters,
+      async: true,
+    });
+
+    const deadline = Date.now() + 10 * 60 * 1000; // 10 minute overall limit
+    let status = job;
+    while (status.status !== "completed") {
+      if (status.status === "failed") {
+        throw new Error(status.error || "Leave letter analysis failed");
+      }
+      if (Date.now() > deadline) {
+        throw new Error("Leave letter analysis timed out");
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+      const response = await fetch(`${ATTENDANCE_SERVICE_URL}${job.status_url}`, {
+        signal: AbortSignal.timeout(10000),
+      });
+      if (!response.ok) {
+        throw new Error(`Service returned ${response.status}`);
+      }
+      status = await response.json();
+    }
+
+    return status.result;
+  }
+
   app.post("/api/leave-letters/upload", async (req, res) => {
     try {
       const { studentName, date, image } = req.body;
@@ -988,9 +1017,7 @@ export async function registerRoutes(
       }
 
       // Call Python service for analysis
-      const result = await callAttendanceService("/api/analyze-leave-letters", {
-        leave_letters
-      });
+      const result = await analyzeWithAttendanceService(leave_letters);
 
       if (!result.success) {
         throw new Error(result.error || "Failed to analyze leave letters");